@@ -0,0 +1,257 @@
+"""
+Benchmark suite
+Sweeps file size, receive buffer size, number of concurrent clients and
+digest algorithm over loopback and reports MB/s, CPU seconds per GB and
+p50/p99 transfer latency for every combination. The receiver runs as a
+subprocess, the clients are threads calling sender.send_file().
+
+Save the results with --output and compare a later run against them with
+--compare to catch regressions. With --rtt or --bandwidth the clients
+connect through wan_proxy.py, to see how the same settings do over a WAN.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import sender
+from transfer_benchmark import RECEIVER_SCRIPT, free_port, wait_for_port
+from wan_proxy import WanProxy
+
+AUTO = "auto"  # Buffer size entry that keeps the receiver's adaptive default
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def process_cpu_seconds(pid):
+    """CPU seconds of another process, None without /proc.
+
+    Sums the nanosecond run time of its threads from schedstat, as the clock
+    ticks in stat are too coarse for short runs. Threads that already ended
+    are missed, the receiver as started here keeps all of its threads. Falls
+    back to the clock ticks when the kernel has no schedstat.
+    """
+    try:
+        nanoseconds = 0
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/schedstat") as f:
+                nanoseconds += int(f.read().split()[0])
+        return nanoseconds / 1e9
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces, the numbers start after its closing parenthesis
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def own_cpu_seconds():
+    """User plus system CPU seconds of this process, all threads included"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def percentile(values, q):
+    """Nearest-rank percentile of values"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))]
+
+class Receiver:
+    """file_receiver_service.py running in a subprocess with one buffer setting.
+
+    Clients connect to port, which is a WanProxy in front of the receiver
+    when link holds its settings.
+    """
+
+    def __init__(self, work_directory, buffer_size, workers, link=None):
+        receiver_port = free_port()
+        self.save_directory = os.path.join(work_directory, "received")
+        command = [sys.executable, RECEIVER_SCRIPT, "-p", str(receiver_port), "-d", self.save_directory, "-w", str(workers),
+                   "--no-catalog"]  # The catalog writer would be measured too, and clear() would delete its database
+        if buffer_size != AUTO:
+            # A fixed size: start at it and never grow past it
+            command += ["-b", str(buffer_size), "--max-buffer-size", str(buffer_size)]
+        self.process = subprocess.Popen(command, cwd=work_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(receiver_port)
+        self.port = receiver_port
+        if link:
+            self.port = free_port()
+            WanProxy(self.port, receiver_port, **link).start()
+
+    def cpu_seconds(self):
+        return process_cpu_seconds(self.process.pid)
+
+    def clear(self):
+        """Delete everything received so far, so the disk does not fill up"""
+        for entry in os.scandir(self.save_directory):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        self.process.wait()
+
+def run_case(receiver, filenames, repeat, digest):
+    """Every client sends its file repeat times, one after the other.
+
+    Returns the wall time of the whole case, the latency of every transfer
+    and the number of transfers that failed.
+    """
+    sender.DIGEST_ALGORITHM = digest
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def client(filename):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                response = sender.send_file(filename, "127.0.0.1", receiver.port)
+            except OSError:
+                response = ""
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if "successfully" not in response:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=client, args=(filename,)) for filename in filenames]
+    start = time.perf_counter()
+    # sender.py reports every step, keep the results table readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return time.perf_counter() - start, latencies, failures[0]
+
+def case_key(result):
+    return (result["size_mib"], str(result["buffer_size"]), result["clients"], result["digest"])
+
+def compare(results, baseline_path, tolerance):
+    """Print the change of every case against a saved run, return how many got slower than tolerance allows"""
+    with open(baseline_path) as f:
+        baseline = {case_key(result): result for result in json.load(f)["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        before = baseline.get(case_key(result))
+        if not before or not before["mb_per_second"]:
+            continue
+        change = result["mb_per_second"] / before["mb_per_second"] - 1
+        slower = change < -tolerance
+        regressions += slower
+        print(f"  {result['size_mib']:>4} MiB  buffer {str(result['buffer_size']):>8}  {result['clients']:>2} client(s)  "
+              f"{result['digest']:<8} {change:>+7.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep the file transfer path over loopback")
+    parser.add_argument("--sizes", help="Comma separated file sizes in MiB, default is 1,16", default="1,16")
+    parser.add_argument("--buffer-sizes", help=f"Comma separated receive buffer sizes in bytes or {AUTO}, default is 4096,65536,1048576,{AUTO}",
+                        default=f"4096,65536,1048576,{AUTO}")
+    parser.add_argument("--clients", help="Comma separated numbers of concurrent clients, default is 1,4", default="1,4")
+    parser.add_argument("--digests", help="Comma separated digest algorithms, default is md5,sha256", default="md5,sha256")
+    parser.add_argument("--repeat", help="Transfers per client and case, default is 5", type=int, default=5)
+    parser.add_argument("--rtt", help="Round-trip time of an emulated WAN link in ms, default is none (loopback)", type=float, default=0)
+    parser.add_argument("--bandwidth", help="Mbit/s of the emulated WAN link, default is unlimited", type=float, default=0)
+    parser.add_argument("--jitter", help="Up to this many ms of random extra delay on the emulated link, default is 0", type=float, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", help="Drop in MB/s that counts as a regression with --compare, default is 0.1 (10%%)",
+                        type=float, default=0.1)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    buffer_sizes = [size if size == AUTO else int(size) for size in args.buffer_sizes.split(",")]
+    client_counts = [int(clients) for clients in args.clients.split(",")]
+    digests = args.digests.split(",")
+    link = None
+    if args.rtt or args.bandwidth or args.jitter:
+        link = {"latency": args.rtt / 2000, "bandwidth": args.bandwidth * 1e6 / 8, "jitter": args.jitter / 1000}
+        print(f"[*] Through an emulated link: {args.rtt:g} ms round trip, "
+              f"{f'{args.bandwidth:g} Mbit/s' if args.bandwidth else 'unlimited bandwidth'}, {args.jitter:g} ms jitter")
+
+    results = []
+    print(f"{'MiB':>5} {'buffer':>8} {'clients':>7} {'digest':<8} {'MB/s':>8} {'p50 s':>8} {'p99 s':>8} "
+          f"{'send CPU/GB':>11} {'recv CPU/GB':>11} {'failed':>6}")
+    with tempfile.TemporaryDirectory() as work_directory:
+        payloads = {}
+        for size in sizes:
+            payloads[size] = os.path.join(work_directory, f"payload-{size}.bin")
+            with open(payloads[size], "wb") as f:
+                f.write(os.urandom(size * 1024 * 1024))
+
+        for buffer_size in buffer_sizes:
+            receiver = Receiver(work_directory, buffer_size, max(client_counts), link)
+            try:
+                # Warm up, the first transfer also pays for imports and page cache misses
+                run_case(receiver, [payloads[sizes[0]]], 1, digests[0])
+                receiver.clear()
+                for size, clients, digest in itertools.product(sizes, client_counts, digests):
+                    # One link per client, so concurrent clients never write the same file name
+                    filenames = []
+                    for client in range(clients):
+                        filename = os.path.join(work_directory, f"client{client}-{size}.bin")
+                        if not os.path.exists(filename):
+                            os.link(payloads[size], filename)
+                        filenames.append(filename)
+                    sender_cpu = own_cpu_seconds()
+                    receiver_cpu = receiver.cpu_seconds()
+                    elapsed, latencies, failures = run_case(receiver, filenames, args.repeat, digest)
+                    sender_cpu = own_cpu_seconds() - sender_cpu
+                    if receiver_cpu is not None:
+                        receiver_cpu = receiver.cpu_seconds() - receiver_cpu
+                    receiver.clear()
+
+                    gigabytes = size * 1024 * 1024 * len(latencies) / 1e9
+                    result = {
+                        "size_mib": size,
+                        "buffer_size": buffer_size,
+                        "clients": clients,
+                        "digest": digest,
+                        "transfers": len(latencies),
+                        "failed": failures,
+                        "seconds": round(elapsed, 4),
+                        "mb_per_second": round(gigabytes * 1000 / elapsed, 2),
+                        "latency_p50": round(percentile(latencies, 0.5), 4),
+                        "latency_p99": round(percentile(latencies, 0.99), 4),
+                        "sender_cpu_per_gb": round(sender_cpu / gigabytes, 3),
+                        "receiver_cpu_per_gb": round(receiver_cpu / gigabytes, 3) if receiver_cpu is not None else None,
+                    }
+                    results.append(result)
+                    receiver_column = f"{result['receiver_cpu_per_gb']:>11.2f}" if receiver_cpu is not None else f"{'n/a':>11}"
+                    print(f"{size:>5} {str(buffer_size):>8} {clients:>7} {digest:<8} {result['mb_per_second']:>8.1f} "
+                          f"{result['latency_p50']:>8.3f} {result['latency_p99']:>8.3f} "
+                          f"{result['sender_cpu_per_gb']:>11.2f} {receiver_column} {failures:>6}")
+            finally:
+                receiver.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "repeat": args.repeat,
+                "link": {"rtt_ms": args.rtt, "bandwidth_mbit": args.bandwidth, "jitter_ms": args.jitter},
+                "results": results,
+            }, f, indent=2)
+        print(f"[+] Results written to {args.output}")
+    failed = sum(result["failed"] for result in results)
+    regressions = compare(results, args.compare, args.tolerance) if args.compare else 0
+    if failed or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Digest benchmark
+Measures how fast each digest algorithm supported by sender.py and
+file_receiver_service.py hashes data on a single core, and whether that is
+enough to keep up with a given link speed
+"""
+import argparse
+import hashlib
+import os
+import time
+from transfer_protocol import DIGEST_ALGORITHMS
+
+CHUNK_SIZE = 1024 * 1024  # Same chunk size the sender hashes with
+
+def measure(algorithm, data, rounds):
+    """Return the MB/s one core hashes data at with algorithm, best of rounds"""
+    view = memoryview(data)
+    best = float("inf")
+    for _ in range(rounds):
+        file_hash = hashlib.new(algorithm)
+        start = time.perf_counter()
+        for offset in range(0, len(data), CHUNK_SIZE):
+            file_hash.update(view[offset:offset + CHUNK_SIZE])
+        file_hash.hexdigest()
+        best = min(best, time.perf_counter() - start)
+    return len(data) / 1e6 / best
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-core throughput of the supported digest algorithms")
+    parser.add_argument("--size", help="MiB of data hashed per round, default is 256", type=int, default=256)
+    parser.add_argument("--rounds", help="Rounds per algorithm, the best one counts, default is 3", type=int, default=3)
+    parser.add_argument("--link", help="Link speed to compare with in Gbit/s, default is 10", type=float, default=10)
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    link_mb = args.link * 1000 / 8
+    print(f"{'algorithm':<10} {'MB/s':>8} {'Gbit/s':>8}  keeps up with {args.link:g} GbE ({link_mb:.0f} MB/s)")
+    for algorithm in DIGEST_ALGORITHMS:
+        mb_per_second = measure(algorithm, data, args.rounds)
+        keeps_up = "yes" if mb_per_second >= link_mb else f"no, {mb_per_second / link_mb:.0%} of line rate"
+        print(f"{algorithm:<10} {mb_per_second:>8.0f} {mb_per_second * 8 / 1000:>8.2f}  {keeps_up}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,402 @@
+"""
+Echo client
+Load generator for echo-server.py, or any other echo service. It keeps many
+connections busy with fixed-size messages and measures the round trip of
+each one, so server implementations and kernel tuning can be compared by
+numbers instead of impressions:
+
+    python echo-client.py -c 100 -s 64 -d 10
+    python echo-client.py -c 1000 --rate 50000 --pipeline 4 -P 4 --json
+
+Without --rate every connection sends its next message as soon as an echo
+came back (closed loop). With --rate messages are due on a fixed schedule
+(open loop), and a message is timed from when it was due, not from when it
+could be sent, so a stalled server cannot hide its queueing delay.
+"""
+import argparse
+import collections
+import heapq
+import json
+import math
+import multiprocessing
+import queue
+import selectors
 import socket
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # Windows has no file descriptor limit to raise
+    resource = None
 
 HOST = "127.0.0.1"  # The server's hostname or IP address
 PORT = 65432  # The port used by the server
+MESSAGE = b"Hello, world"  # Repeated or cut to fill every message
+RECEIVE_SIZE = 64 * 1024  # Bytes read at once
+SIGNIFICANT_DIGITS = 3  # Precision the latency histogram keeps for every value
+MAX_OPEN_FILES = 65536  # Descriptor limit asked for when the hard limit is unlimited
+PERCENTILES = (50, 90, 99, 99.9)  # Reported after every run
+
+class LatencyHistogram:
+    """Counts of latencies in microseconds, bucketed like an HDR histogram.
+
+    Values below 2 * 10**digits are counted exactly. Above that every power
+    of two is split into the same number of linear sub-buckets, so each
+    value keeps digits significant digits, from microseconds to minutes,
+    and memory only grows with the number of distinct buckets used.
+    """
+
+    def __init__(self, digits=SIGNIFICANT_DIGITS):
+        self.bits = (2 * 10 ** digits - 1).bit_length()
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket(self, value):
+        """(shift, sub-bucket) of value, ordered like the values they hold"""
+        shift = max(0, value.bit_length() - self.bits)
+        return shift, value >> shift
+
+    @staticmethod
+    def highest(bucket):
+        """Largest value counted in bucket"""
+        shift, sub_bucket = bucket
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same precision"""
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """Smallest recorded value that p percent of the values do not exceed"""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.highest(bucket), self.max)
+        return self.max
+
+    def distribution(self):
+        """(value, percentile, count) rows at 0, 50, 75, 87.5, ... and 100
+        percent, the ladder HdrHistogram prints, until it reaches the max"""
+        rows = []
+        step = 0
+        while self.count:
+            p = 100 * (1 - 0.5 ** step)
+            value = self.percentile(p)
+            rows.append((value, p, max(1, math.ceil(p / 100 * self.count))))
+            if value >= self.max or self.count * 0.5 ** step < 1:
+                break
+            step += 1
+        if self.count:
+            rows.append((self.max, 100.0, self.count))
+        return rows
+
+class Client:
+    """One connection and the messages it has in flight"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outgoing = bytearray()         # Bytes not written yet
+        self.in_flight = collections.deque()  # Times the unanswered messages count from
+        self.queued = collections.deque()   # Due times of messages waiting for a pipeline slot
+        self.received = 0                   # Bytes of the echo that is coming in
+        self.writing = False
+        self.closed = False
+
+class LoadGenerator:
+    """Drives connections to one echo server from a single selector loop.
+
+    size is the bytes of every message and pipeline how many may be
+    unanswered on a connection. rate is messages per second for all
+    connections together, 0 runs closed loop.
+    """
+
+    def __init__(self, host, port, connections, size, rate=0, pipeline=1):
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.size = size
+        self.payload = (MESSAGE * (size // len(MESSAGE) + 1))[:size]
+        self.rate = rate
+        self.pipeline = pipeline
+        self.selector = selectors.DefaultSelector()
+        self.buffer = bytearray(RECEIVE_SIZE)
+        self.clients = []
+        self.histogram = LatencyHistogram()
+        self.stats = collections.Counter()
+
+    def connect(self):
+        for _ in range(self.connections):
+            sock = socket.create_connection((self.host, self.port))
+            # Messages are small and must not wait for more data to fill a segment
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            client = Client(sock)
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+
+    def run(self, duration, warmup=0):
+        """Send for warmup plus duration seconds and measure the last duration seconds"""
+        now = time.perf_counter()
+        self.measure_from = now + warmup
+        self.stop_at = self.measure_from + duration
+        schedule = []
+        if self.rate:
+            # Spread the connections evenly over the interval between their messages
+            interval = len(self.clients) / self.rate
+            schedule = [(now + i / self.rate, i) for i in range(len(self.clients))]
+        else:
+            for client in self.clients:
+                for _ in range(self.pipeline):
+                    self.issue(client, now)
+
+        while self.stats["errors"] < len(self.clients):
+            now = time.perf_counter()
+            if now >= self.stop_at:
+                break
+            while schedule and schedule[0][0] <= now:
+                due, i = heapq.heappop(schedule)
+                client = self.clients[i]
+                if client.closed:
+                    continue
+                if len(client.in_flight) < self.pipeline:
+                    self.issue(client, due)
+                else:
+                    client.queued.append(due)
+                heapq.heappush(schedule, (due + interval, i))
+            wake_at = min(schedule[0][0], self.stop_at) if schedule else self.stop_at
+            for key, events in self.selector.select(max(0, wake_at - now)):
+                if events & selectors.EVENT_READ:
+                    self.receive(key.data)
+                if events & selectors.EVENT_WRITE and not key.data.closed:
+                    self.flush(key.data)
+
+        # Shorter than duration when every connection was lost early
+        elapsed = max(0, min(time.perf_counter(), self.stop_at) - self.measure_from)
+        for client in self.clients:
+            if not client.closed:
+                # Expected at the deadline, open loop also counts messages still waiting to be sent
+                self.stats["in_flight"] += len(client.in_flight) + len(client.queued)
+                self.close(client)
+        self.selector.close()
+        return {"histogram": self.histogram, "completed": self.stats["completed"], "bytes": self.stats["bytes"],
+                "errors": self.stats["errors"], "lost": self.stats["lost"], "in_flight": self.stats["in_flight"],
+                "elapsed": elapsed}
+
+    def issue(self, client, due):
+        """Send one message that is timed from due"""
+        client.in_flight.append(due)
+        client.outgoing += self.payload
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outgoing)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.fail(client)
+            return
+        del client.outgoing[:sent]
+        # Only wait for the socket to become writable while something is left
+        if client.outgoing and not client.writing:
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            client.writing = True
+        elif not client.outgoing and client.writing:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+            client.writing = False
+
+    def receive(self, client):
+        try:
+            nbytes = client.sock.recv_into(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            nbytes = 0
+        if not nbytes:
+            self.fail(client)
+            return
+        now = time.perf_counter()
+        measuring = now >= self.measure_from
+        if measuring:
+            self.stats["bytes"] += nbytes
+        client.received += nbytes
+        # The echoes come back in order, so every full message answers the oldest one
+        while client.received >= self.size and client.in_flight:
+            client.received -= self.size
+            due = client.in_flight.popleft()
+            if measuring:
+                self.histogram.record((now - due) * 1e6)
+                self.stats["completed"] += 1
+            if not self.rate:
+                self.issue(client, now)
+            elif client.queued:
+                self.issue(client, client.queued.popleft())
+            if client.closed:
+                return
+
+    def fail(self, client):
+        """The server closed or broke the connection"""
+        self.stats["errors"] += 1
+        self.stats["lost"] += len(client.in_flight) + len(client.queued)
+        self.close(client)
+
+    def close(self, client):
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        client.closed = True
+
+def run_worker(options, connections, rate, barrier, results):
+    """Connect, wait until every worker is connected, then run and put the result on results"""
+    generator = LoadGenerator(options.host, options.port, connections, options.size, rate, options.pipeline)
+    try:
+        generator.connect()
+    except OSError as e:
+        if barrier:
+            barrier.abort()
+        results.put(f"Cannot connect to {options.host}:{options.port}: {e}")
+        return
+    if barrier:
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            results.put(None)
+            return
+    results.put(generator.run(options.duration, options.warmup))
+
+def run_load(options):
+    """Split the connections and the rate over options.processes worker
+    processes, so the client does not become the bottleneck, and merge
+    their results"""
+    processes = options.processes
+    shares = [options.connections // processes + (i < options.connections % processes) for i in range(processes)]
+    if processes == 1:
+        results = queue.Queue()
+        run_worker(options, options.connections, options.rate, None, results)
+        outcomes = [results.get()]
+    else:
+        results = multiprocessing.Queue()
+        barrier = multiprocessing.Barrier(processes)
+        workers = [multiprocessing.Process(target=run_worker, daemon=True,
+                                           args=(options, share, options.rate * share / options.connections, barrier, results))
+                   for share in shares]
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+    errors = [outcome for outcome in outcomes if isinstance(outcome, str)]
+    if errors or None in outcomes:
+        raise ConnectionError(errors[0] if errors else "A worker did not start")
+    total = {"histogram": LatencyHistogram(), "completed": 0, "bytes": 0, "errors": 0, "lost": 0, "in_flight": 0, "elapsed": 0}
+    for outcome in outcomes:
+        total["histogram"].merge(outcome["histogram"])
+        for name in ("completed", "bytes", "errors", "lost", "in_flight"):
+            total[name] += outcome[name]
+        total["elapsed"] = max(total["elapsed"], outcome["elapsed"])
+    return total
+
+def raise_file_limit():
+    """Raise the soft limit of open files to the hard limit, it is often
+    only 1024, and return the new limit. Every connection needs one."""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else hard
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+def milliseconds(microseconds):
+    return f"{microseconds / 1000:.3f}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for an echo server")
+    parser.add_argument("-H", "--host", help=f"Address of the server, default is {HOST}", default=HOST)
+    parser.add_argument("-p", "--port", help=f"Port of the server, default is {PORT}", type=int, default=PORT)
+    parser.add_argument("-c", "--connections", help="Concurrent connections, default is 10", type=int, default=10)
+    parser.add_argument("-s", "--size", help="Bytes per message, default is 64", type=int, default=64)
+    parser.add_argument("-d", "--duration", help="Seconds to measure, default is 10", type=float, default=10)
+    parser.add_argument("--warmup", help="Seconds to send before measuring, default is 1", type=float, default=1)
+    parser.add_argument("--rate", help="Messages per second over all connections, default is closed loop", type=float, default=0)
+    parser.add_argument("--pipeline", help="Messages a connection may have unanswered, default is 1", type=int, default=1)
+    parser.add_argument("-P", "--processes", help="Worker processes sharing the connections, default is 1", type=int, default=1)
+    parser.add_argument("--histogram", help="Also print the latency distribution", action="store_true")
+    parser.add_argument("--json", help="Print the results as one JSON object", action="store_true")
+    args = parser.parse_args()
+    if min(args.connections, args.size, args.pipeline, args.processes) < 1:
+        parser.error("--connections, --size, --pipeline and --processes must be at least 1")
+    if args.processes > args.connections:
+        parser.error("--processes cannot be more than --connections")
+    if args.duration <= 0 or args.warmup < 0 or args.rate < 0:
+        parser.error("--duration must be positive, --warmup and --rate not negative")
+
+    raise_file_limit()
+    mode = f"{args.rate:g} messages/s" if args.rate else "closed loop"
+    if not args.json:
+        print(f"[*] {args.connections} connection(s) to {args.host}:{args.port}, {args.size}-byte messages, {mode}, "
+              f"{args.pipeline} in flight per connection, {args.warmup:g} s warmup and {args.duration:g} s measured")
+    try:
+        result = run_load(args)
+    except ConnectionError as e:
+        print(f"[!] {e}")
+        sys.exit(1)
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.connect((HOST, PORT))
-    s.sendall(b"Hello, world")
-    data = s.recv(1024)
+    histogram = result["histogram"]
+    elapsed = result["elapsed"]
+    if not result["completed"]:
+        print(f"[!] No echo came back while measuring, {result['errors']} connection(s) lost")
+        sys.exit(1)
+    if args.json:
+        print(json.dumps({
+            "host": args.host, "port": args.port, "connections": args.connections, "size": args.size,
+            "rate": args.rate, "pipeline": args.pipeline, "duration": elapsed,
+            "requests": result["completed"], "requests_per_second": result["completed"] / elapsed,
+            "mb_per_second": result["bytes"] / elapsed / 1e6, "errors": result["errors"], "lost": result["lost"],
+            "in_flight": result["in_flight"],
+            "latency_us": {"min": histogram.min or 0, "mean": histogram.mean(), "max": histogram.max,
+                           **{f"p{p:g}": histogram.percentile(p) for p in PERCENTILES}},
+        }))
+        sys.exit(0)
 
-print(f"Received {data!r}")
\ No newline at end of file
+    print(f"[+] {result['completed']} requests, {result['completed'] / elapsed:.1f} requests/s, "
+          f"{result['bytes'] / elapsed / 1e6:.2f} MB/s echoed, {result['in_flight']} in flight at the end")
+    if result["errors"]:
+        print(f"[!] {result['errors']} connection(s) lost with {result['lost']} message(s) unanswered")
+    print(f"[*] Latency in ms: min {milliseconds(histogram.min or 0)}, mean {milliseconds(histogram.mean())}, "
+          + ", ".join(f"p{p:g} {milliseconds(histogram.percentile(p))}" for p in PERCENTILES)
+          + f", max {milliseconds(histogram.max)}")
+    if args.histogram:
+        print(f"{'Value (ms)':>12} {'Percentile':>12} {'TotalCount':>12} {'1/(1-Percentile)':>18}")
+        for value, p, count in histogram.distribution():
+            inverse = f"{1 / (1 - p / 100):.2f}" if p < 100 else "inf"
+            print(f"{milliseconds(value):>12} {p / 100:>12.6f} {count:>12} {inverse:>18}")
@@ -1,16 +1,203 @@
+"""
+Echo server
+Sends back whatever its clients send. A single thread serves thousands of
+connections: the selector (epoll on Linux, kqueue on macOS) reports which
+sockets are ready, and only those are read from or written to. It is the
+reference TCP service and latency baseline for echo-client.py
+"""
+import argparse
+import collections
+import selectors
 import socket
+import time
+try:
+    import resource
+except ImportError:
+    # Windows has no file descriptor limit to raise
+    resource = None
 
 HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
 PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
+BACKLOG = 1024  # Connections the kernel holds until they are accepted
+BUFFER_SIZE = 64 * 1024  # Bytes of every pooled receive buffer
+POOL_SIZE = 1024  # Free buffers kept for reuse, more are left to the garbage collector
+MAX_OPEN_FILES = 65536  # Descriptor limit asked for when the hard limit is unlimited
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen()
-    conn, addr = s.accept()
-    with conn:
-        print(f"Connected by {addr}")
+class BufferPool:
+    """Receive buffers that are handed out and taken back instead of being
+    allocated for every read. Only the event loop thread uses it."""
+
+    def __init__(self, size, keep):
+        self.size = size
+        self.keep = keep
+        self.free = []
+        self.allocated = 0
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self.free) < self.keep:
+            self.free.append(buffer)
+
+class Connection:
+    """One client and the echo that did not fit into its socket yet"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = None   # Pooled buffer holding the unsent bytes
+        self.pending = None  # memoryview of those bytes
+
+class EchoServer:
+    """Non-blocking echo server around one selector.
+
+    Every read goes into a pooled buffer with recv_into() and is sent back
+    right away with one non-blocking send(). Whatever the client's socket
+    cannot take stays in the buffer, and the connection stops being read
+    until it went out. A client that does not read its echoes therefore
+    only ever holds one buffer, and its kernel send buffer fills up instead
+    of the server's memory.
+    """
+
+    def __init__(self, host, port):
+        self.selector = selectors.DefaultSelector()
+        self.pool = BufferPool(BUFFER_SIZE, POOL_SIZE)
+        self.stats = collections.Counter()
+        self.open = 0
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(BACKLOG)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+
+    def serve_forever(self, stats_interval=0):
+        """Run the event loop, printing the counters every stats_interval seconds"""
+        next_report = time.monotonic() + stats_interval
         while True:
-            data = conn.recv(1024)
-            if not data:
-                break
-            conn.sendall(data)
\ No newline at end of file
+            timeout = max(0, next_report - time.monotonic()) if stats_interval else None
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self.accept()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read(key.data)
+                elif events & selectors.EVENT_WRITE:
+                    self.write(key.data)
+            if stats_interval and time.monotonic() >= next_report:
+                print(f"[*] {self.report()}")
+                next_report += stats_interval
+
+    def accept(self):
+        """Accept every connection that is waiting, not just one"""
+        while True:
+            try:
+                sock, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors, the rest wait in the backlog
+                self.stats["accept_errors"] += 1
+                print(f"[!] Cannot accept: {e}")
+                return
+            sock.setblocking(False)
+            # Echoes are small and must not wait for more data to fill a segment
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.selector.register(sock, selectors.EVENT_READ, Connection(sock, address))
+            self.stats["accepted"] += 1
+            self.open += 1
+
+    def read(self, connection):
+        buffer = self.pool.acquire()
+        try:
+            nbytes = connection.sock.recv_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            self.pool.release(buffer)
+            return
+        except OSError:
+            nbytes = 0
+        if not nbytes:
+            # The client is done, or the connection broke
+            self.pool.release(buffer)
+            self.close(connection)
+            return
+        self.stats["bytes"] += nbytes
+        view = memoryview(buffer)[:nbytes]
+        try:
+            sent = connection.sock.send(view)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.pool.release(buffer)
+            self.close(connection)
+            return
+        if sent == nbytes:
+            self.pool.release(buffer)
+            return
+        # Backpressure: keep the rest and stop reading until the client took it
+        connection.buffer = buffer
+        connection.pending = view[sent:]
+        self.stats["paused"] += 1
+        self.selector.modify(connection.sock, selectors.EVENT_WRITE, connection)
+
+    def write(self, connection):
+        try:
+            sent = connection.sock.send(connection.pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(connection)
+            return
+        connection.pending = connection.pending[sent:]
+        if not connection.pending:
+            self.pool.release(connection.buffer)
+            connection.buffer = connection.pending = None
+            self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+
+    def close(self, connection):
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        if connection.buffer is not None:
+            self.pool.release(connection.buffer)
+            connection.buffer = connection.pending = None
+        self.open -= 1
+
+    def report(self):
+        return (f"{self.open} open, {self.stats['accepted']} accepted, {self.stats['bytes'] / 1e6:.1f} MB echoed, "
+                f"{self.stats['paused']} backpressure pause(s), {self.pool.allocated} buffer(s) allocated")
+
+def raise_file_limit():
+    """Raise the soft limit of open files to the hard limit, it is often
+    only 1024, and return the new limit. Every connection needs one."""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else hard
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Echo server for many concurrent clients")
+    parser.add_argument("-H", "--host", help=f"Address to listen on, default is {HOST}", default=HOST)
+    parser.add_argument("-p", "--port", help=f"Port to listen on, default is {PORT}", type=int, default=PORT)
+    parser.add_argument("--stats", help="Print the counters every this many seconds, default is never", type=float, default=0)
+    args = parser.parse_args()
+
+    limit = raise_file_limit()
+    server = EchoServer(args.host, args.port)
+    print(f"[*] Echo server listening on {args.host}:{args.port} with {type(server.selector).__name__}"
+          + (f", up to {limit} open files" if limit else ""))
+    print("[*] Press Ctrl+C to stop")
+    try:
+        server.serve_forever(args.stats)
+    except KeyboardInterrupt:
+        print(f"\n[*] {server.report()}")
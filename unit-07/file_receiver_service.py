@@ -1,94 +1,1347 @@
 """
 File receiver service
-This service continuously listens for incoming files and handles multiple clients sequentially
+This service continuously listens for incoming files and handles multiple clients,
+either sequentially or concurrently with a bounded pool of worker threads
 """
 import socket
+import selectors
 import tqdm
 import os
 import datetime
 import logging
 import hashlib
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='file_receiver.log',
-    filemode='a'
-)
+import argparse
+import threading
+import zlib
+import lzma
+import bz2
+import shutil
+import string
+import queue
+import time
+import collections
+import itertools
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from transfer_protocol import (HEADER, MAGIC, FLAG_TRAILER, FLAG_RESUME, FLAG_RANGE, FLAG_QUERY, FLAG_DELTA, NEED, DELTA, BUSY,
+                               SIGNATURE, DELTA_OP, DELTA_COPY, DELTA_LITERAL, DELTA_END, delta_block_size, strong_checksum,
+                               CODEC_NONE, CODEC_ZLIB, CODEC_LZMA, CODEC_BZ2, CHUNK_LENGTH,
+                               FileHeader, ProtocolError, unpack_header)
+from transfer_metrics import MB_PER_SECOND_BUCKETS, Metrics, serve_metrics
+from transfer_catalog import CATALOG_FILE, Catalog
 
 # Server configuration
 SERVER_HOST = "0.0.0.0"  # Listen on all network interfaces
 SERVER_PORT = 5001       # Port to listen on
-BUFFER_SIZE = 4096       # Bytes to receive at once
-SEPARATOR = "<SEPARATOR>"  # Delimiter for metadata
+BUFFER_SIZE = 4096       # Bytes to receive at once (starting size)
+MAX_BUFFER_SIZE = 4 * 1024 * 1024  # Largest chunk the receive buffer grows to
+PROGRESS_MIN_SIZE = 1024 * 1024    # Smaller files get no progress bar
+MAX_COMPRESSED_CHUNK = 16 * 1024 * 1024  # Largest compressed chunk a sender may send
+SEPARATOR = "<SEPARATOR>"  # Delimiter for metadata in the text protocol
+TRAILER = "TRAILER"        # Sent instead of the MD5 when it follows the file data (text protocol, always MD5)
+RESUME = "RESUME"          # Optional fourth metadata field asking for a resumable transfer (text protocol)
+RESUME_CHUNK = 1024 * 1024 # Bytes covered by each checksum of a partial file
+RANGE = "RANGE"            # Optional metadata field followed by the offset and length of one part of a file (text protocol)
 SAVE_DIRECTORY = "received_files"  # Directory to save received files
+EXTRA_ROOTS = []                   # More directories, e.g. on other disks, that received files are spread over by name
+STORAGE_LAYOUT = "flat"            # "flat" puts every upload straight into its root, "date" and "hash" into sub-directories
+PARTIAL_DIRECTORY = ".partial"     # Sub-directory of every root for interrupted transfers
+OBJECTS_DIRECTORY = ".objects"     # Sub-directory of every root holding every stored content once, by digest
+LATEST_DIRECTORY = ".latest"       # Sub-directory of every root with the newest copy of every file name, the base for deltas
+MAX_LITERAL = 16 * 1024 * 1024     # Largest run of new bytes a delta may send at once
+WORKERS = 1              # Concurrent transfers, 1 handles clients sequentially
+QUEUE_SIZE = 16          # Accepted clients that may wait for a worker, more are turned away as busy
+LISTEN_BACKLOG = 128     # Connections the kernel holds until they are accepted
+BUSY_RETRY_AFTER = 5     # Seconds a busy client is told to wait before trying again
+REJECT_LINGER = 5        # Seconds to read what a busy client already sent, so closing does not reset the connection
+MAX_DRAINING = 256       # Busy clients read from at once, more are closed right after the busy line
+DRAIN_CHUNK = 64 * 1024  # Bytes of a busy client read and thrown away at once
+CLIENT_TIMEOUT = 300     # Seconds a silent client may hold a connection
+RANGE_EXPIRY = 3600      # Seconds an unfinished file sent in ranges is kept after its last connection ended
+PARTIAL_EXPIRY = 24 * 3600  # Seconds an unfinished resumable upload is kept after it was last written to
+TAKEOVER_WAIT = 10       # Seconds a reconnecting sender waits for the old connection of its resumable upload to let go
+LOG_FILE = "file_receiver.log"  # Where the log goes, written by a background thread
+LOG_SAMPLE = 1           # Keep the INFO lines of every Nth connection only, warnings and errors are always kept
+FSYNC_POLICY = "never"   # "file" syncs every file before acknowledging it, "batch" syncs groups of files, "never" leaves it to the OS
+FSYNC_BATCH_FILES = 32   # With "batch", sync as soon as this many files are waiting...
+FSYNC_BATCH_SECONDS = 1.0  # ...or the oldest of them has waited this long
+PIPELINE_DEPTH = 0       # Buffers in flight between the receive, hash and write stages, 0 runs them in series
+PIPELINE_BUFFER_SIZE = 1024 * 1024  # Size of each of those buffers
+RATE_LIMIT = 0           # Bytes per second all uploads together may use, 0 is unlimited
+CLIENT_RATE_LIMIT = 0    # Bytes per second the uploads of one client IP may use, 0 is unlimited
+FAIR_SHARE = False       # Split RATE_LIMIT evenly over the client IPs receiving at the moment
+BURST_SECONDS = 0.1      # A token bucket holds this many seconds worth of its rate
+MIN_BURST = 64 * 1024    # ...but at least this many bytes
+ACTIVE_WINDOW = 1.0      # Seconds a connection counts towards the fair share after its last read
+
+# Decompressors for the codecs a sender may choose
+DECOMPRESSORS = {
+    CODEC_ZLIB: zlib.decompressobj,
+    CODEC_LZMA: lzma.LZMADecompressor,
+    CODEC_BZ2: bz2.BZ2Decompressor,
+}
+
+# Partial files currently being written, with the connection writing each, so two connections never resume the same one
+active_partials = {}
+active_partials_lock = threading.Lock()
+
+# Files arriving as byte ranges over several connections, by transfer key
+range_transfers = {}
+range_transfers_lock = threading.Lock()
+
+# Last session timestamp handed out and how often it was handed out, so two sessions never share one
+last_stamp = None
+stamp_repeats = 0
+stamp_lock = threading.Lock()
+
+# Files moved into place but not synced yet, with the "batch" fsync policy
+unsynced_files = []
+unsynced_files_lock = threading.Lock()
+unsynced_since = None
+
+# Whether the connection served by the current thread has its INFO lines logged
+log_context = threading.local()
+connection_counter = itertools.count()
+
+# Counters and histograms of everything received, see transfer_metrics.py
+metrics = Metrics()
+
+# Record of every stored file, see transfer_catalog.py, None when disabled
+catalog = None
+
+# Bandwidth shaping: the global bucket, the buckets of every client IP, how many
+# connections each client has open and when each client last read data
+global_bucket = None
+client_buckets = {}
+fair_buckets = {}
+throttled_connections = collections.Counter()
+last_reads = {}
+throttle_lock = threading.Lock()
+
+class ConnectionSampler(logging.Filter):
+    """Drops the INFO lines of connections that were not picked for the log sample"""
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or getattr(log_context, "sampled", True)
+
+def setup_logging():
+    """Log to LOG_FILE through a queue.
+
+    Connection threads put records on the queue and a QueueListener
+    thread writes them, so a slow log disk never holds up a transfer.
+    Sampled-out and disabled records are never formatted at all; the
+    message of a kept one is still merged with its arguments on the
+    connection thread. Returns the listener, stop it to flush the queue.
+    """
+    file_handler = logging.FileHandler(LOG_FILE, mode="a")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ConnectionSampler())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
 
 def ensure_save_directory():
-    """Create save directory if it doesn't exist"""
-    if not os.path.exists(SAVE_DIRECTORY):
-        os.makedirs(SAVE_DIRECTORY)
-        logging.info(f"Created directory: {SAVE_DIRECTORY}")
+    """Create the save directory and the other roots if they don't exist"""
+    for root in storage_roots():
+        if not os.path.exists(root):
+            os.makedirs(root)
+            logging.info("Created directory: %s", root)
+
+class ChunkLog:
+    """Record the digest of every completed RESUME_CHUNK of a partial file,
+    one hex digest per line, so an interrupted transfer can be resumed"""
+
+    def __init__(self, path, algorithm):
+        self.file = open(path, "a")
+        self.algorithm = algorithm
+        self.chunk_hash = hashlib.new(algorithm)
+        self.filled = 0
+
+    def update(self, data):
+        """Hash data and write a checksum line at every chunk boundary"""
+        while data:
+            take = min(len(data), RESUME_CHUNK - self.filled)
+            self.chunk_hash.update(data[:take])
+            self.filled += take
+            data = data[take:]
+            if self.filled == RESUME_CHUNK:
+                self.file.write(self.chunk_hash.hexdigest() + "\n")
+                self.file.flush()
+                self.chunk_hash = hashlib.new(self.algorithm)
+                self.filled = 0
+
+    def close(self):
+        self.file.close()
+
+def verify_partial(part_path, log_path, algorithm):
+    """Check a partial file against its chunk log.
+
+    Returns the last verified offset and a hash object already fed with the
+    verified bytes. Anything after the first bad chunk is cut off.
+    """
+    file_hash = hashlib.new(algorithm)
+    offset = 0
+    verified = []
+    if os.path.exists(part_path) and os.path.exists(log_path):
+        with open(log_path) as log:
+            checksums = log.read().split()
+        with open(part_path, "rb") as f:
+            for checksum in checksums:
+                chunk = f.read(RESUME_CHUNK)
+                if len(chunk) < RESUME_CHUNK or hashlib.new(algorithm, chunk).hexdigest() != checksum:
+                    break
+                file_hash.update(chunk)
+                verified.append(checksum)
+                offset += len(chunk)
+    # Keep only what was verified
+    with open(part_path, "ab") as f:
+        f.truncate(offset)
+    with open(log_path, "w") as log:
+        log.writelines(checksum + "\n" for checksum in verified)
+    return offset, file_hash
+
+class PositionalWriter:
+    """File-like writer that puts data at a fixed place in a shared file
+    with os.pwrite(), so several connections can fill one file at once"""
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        while data:
+            written = os.pwrite(self.fd, data, self.offset)
+            self.offset += written
+            data = data[written:]
+
+def transfer_key(filename, filesize, expected_digest):
+    """Identify a file by name, size and digest across connections"""
+    return hashlib.md5(f"{filename}{SEPARATOR}{filesize}{SEPARATOR}{expected_digest}".encode()).hexdigest()
 
-def receive_file(client_socket, client_address):
-    """Handle file reception from a client"""
+def file_digest(path, algorithm):
+    """Hex digest of a file on disk"""
+    file_hash = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(RESUME_CHUNK), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def object_path(algorithm, digest, root):
+    """Path of some content in the content-addressed store of a root"""
+    return os.path.join(root, OBJECTS_DIRECTORY, algorithm, digest[:2], digest)
+
+def find_content(name, algorithm, digest, size):
+    """Path of stored content with this digest and size, or None. The root
+    name is stored under comes first, from there it can be hard-linked.
+    Content someone made writable again may have been edited and is not used."""
+    root = storage_root(name)
+    for candidate in [root] + [other for other in storage_roots() if other != root]:
+        path = object_path(algorithm, digest, candidate)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.st_size == size and not stat.st_mode & 0o222:
+            return path
+    return None
+
+def remember_content(file_path, algorithm, digest, root):
+    """Hard-link a verified file into the content-addressed store of its
+    root, so the same content can later be linked into place instead of
+    sent again.
+
+    The link shares its data with the received file, which finish_file()
+    made read-only, so editing it in place cannot change what later
+    uploads of that content are linked to.
+    """
+    path = object_path(algorithm, digest, root)
+    if os.path.exists(path) and not os.stat(path).st_mode & 0o222:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
     try:
-        # Receive the file info
-        received = client_socket.recv(BUFFER_SIZE).decode()
-        if not received:
-            logging.warning(f"Client {client_address} connected but sent no data")
+        # Replaces content that was made writable again with this verified copy
+        link_content(file_path, path)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logging.warning("Cannot add %s to the content store: %s", file_path, e)
+
+def preallocate(fd, size):
+    """Reserve size bytes on disk for fd up front, so a large file is laid
+    out in one piece. Returns False where that is not possible."""
+    if not size or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError:
+        # The file system does not support it
+        return False
+
+def sync_path(path):
+    """fsync a file or directory by name, a no-op where directories cannot be opened"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def sync_files(paths):
+    """Flush the data of paths and then their directory entries to disk"""
+    started = time.perf_counter()
+    for path in paths:
+        sync_path(path)
+    for directory in {os.path.dirname(path) for path in paths}:
+        sync_path(directory)
+    metrics.observe("fsync_seconds", time.perf_counter() - started)
+
+def sync_unsynced_files(force=False):
+    """Sync the waiting files of the "batch" policy once there are enough of them or they waited long enough"""
+    global unsynced_since
+    with unsynced_files_lock:
+        due = unsynced_files and (force or len(unsynced_files) >= FSYNC_BATCH_FILES
+                                  or time.monotonic() - unsynced_since >= FSYNC_BATCH_SECONDS)
+        if not due:
             return
-            
-        filename, filesize, expected_md5 = received.split(SEPARATOR)
-        # Remove absolute path if there is
-        filename = os.path.basename(filename)
-        # Generate unique filename with timestamp
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
+        paths = list(unsynced_files)
+        unsynced_files.clear()
+    sync_files(paths)
+
+def sync_batches_periodically():
+    """Background thread of the "batch" policy, so a last few files do not wait forever"""
+    while True:
+        time.sleep(FSYNC_BATCH_SECONDS)
+        sync_unsynced_files()
+
+def finish_file(temporary_path, file_path):
+    """Atomically move a verified file from its temporary name into place,
+    read-only and synced to disk as FSYNC_POLICY says"""
+    global unsynced_since
+    # Stored files may share their data with the content store through hard links
+    os.chmod(temporary_path, 0o444)
+    if FSYNC_POLICY == "file":
+        # Data first, then the rename, so the name never points at missing data
+        started = time.perf_counter()
+        sync_path(temporary_path)
+        os.replace(temporary_path, file_path)
+        sync_path(os.path.dirname(file_path))
+        metrics.observe("fsync_seconds", time.perf_counter() - started)
+        return
+    os.replace(temporary_path, file_path)
+    if FSYNC_POLICY == "batch":
+        with unsynced_files_lock:
+            if not unsynced_files:
+                unsynced_since = time.monotonic()
+            unsynced_files.append(file_path)
+        sync_unsynced_files()
+
+def link_content(source, file_path):
+    """Put a copy of stored content at file_path, as a hard link when possible"""
+    if os.path.exists(file_path) and os.path.samefile(source, file_path):
+        return
+    temporary_path = f"{file_path}.link"
+    try:
+        os.link(source, temporary_path)
+    except OSError:
+        shutil.copyfile(source, temporary_path)
+    os.replace(temporary_path, file_path)
+
+def catalog_file(header, file_path, digest, client_address, started, method):
+    """Record a stored file in the catalog"""
+    if catalog:
+        catalog.record(header.name, os.path.abspath(file_path), header.size, header.algorithm, digest,
+                       client_address[0], started, time.time(), method)
+
+def answer_query(client_socket, client_address, header, reply, timestamp):
+    """Tell the sender whether its file is needed. Known content is linked
+    into place right away and counts as received. A delta query about
+    unknown content gets the signatures of the previous copy instead."""
+    digest = header.digest.lower()
+    if not digest or not all(c in string.hexdigits for c in digest):
+        raise ProtocolError(f"Invalid digest {header.digest!r}")
+    path = find_content(header.name, header.algorithm, digest, header.size)
+    if not path:
+        if header.flags & FLAG_DELTA:
+            send_signatures(client_socket, header, reply)
+        else:
+            reply(NEED)
+        return
+    started = time.time()
+    file_path = destination_path(header.name, timestamp)
+    # Under the same fsync policy as an upload, it counts as received once the reply is out
+    temporary_path = f"{file_path}.tmp"
+    link_content(path, temporary_path)
+    finish_file(temporary_path, file_path)
+    remember_latest(header.name, file_path)
+    catalog_file(header, file_path, digest, client_address, started, "dedup")
+    logging.info("File %s from %s linked from stored content", os.path.relpath(file_path, storage_root(header.name)), client_address)
+    reply(f"File received successfully - already stored ({header.algorithm.upper()} verified)")
+
+def delta_base_path(header):
+    """Snapshot of the previous copy that a delta upload is built on"""
+    key = transfer_key(header.name, header.size, header.digest.lower())
+    return os.path.join(storage_root(header.name), PARTIAL_DIRECTORY, f"{key}.base")
+
+def send_signatures(client_socket, header, reply):
+    """Send the block signatures of the previous copy of the file, or NEED
+    when there is none.
+
+    The previous copy is hard-linked to a base snapshot first, so a newer
+    upload of the same name cannot change it before the delta arrives.
+    """
+    latest = latest_path(header.name)
+    if not os.path.exists(latest):
+        reply(NEED)
+        return
+    base_path = delta_base_path(header)
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    link_content(latest, base_path)
+    block_size = delta_block_size(os.path.getsize(base_path))
+    signatures = bytearray()
+    with open(base_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            signatures += SIGNATURE.pack(zlib.adler32(block), strong_checksum(block))
+    reply(f"{DELTA}{SEPARATOR}{block_size}{SEPARATOR}{len(signatures) // SIGNATURE.size}")
+    client_socket.sendall(signatures)
+
+def receive_delta(client_socket, client_address, header, reply, timestamp):
+    """Rebuild a file from copies of blocks of its base snapshot and the
+    literal bytes that changed. Returns False when the delta stopped early."""
+    base_path = delta_base_path(header)
+    if not os.path.exists(base_path):
+        raise ProtocolError(f"Delta for {header.name} without signatures")
+    started = time.time()
+    file_path = destination_path(header.name, timestamp)
+    filename = os.path.relpath(file_path, storage_root(header.name))
+    temporary_path = f"{file_path}.tmp"
+    file_hash = hashlib.new(header.algorithm)
+    logging.info("Receiving delta of %s (%s bytes) from %s", filename, header.size, client_address)
+    progress = tqdm.tqdm(range(header.size), f"Receiving {filename}", unit="B", unit_scale=True, unit_divisor=1024,
+                         disable=header.size < PROGRESS_MIN_SIZE)
+    base_fd = os.open(base_path, os.O_RDONLY)
+    base_size = os.fstat(base_fd).st_size
+    block_size = delta_block_size(base_size)
+    complete = False
+    written = literal_bytes = 0
+    try:
+        with open(temporary_path, "wb") as f:
+            preallocate(f.fileno(), header.size)
+            while True:
+                op = receive_exact(client_socket, DELTA_OP.size)
+                if len(op) < DELTA_OP.size:
+                    break
+                op, first, count = DELTA_OP.unpack(op)
+                if op == DELTA_END:
+                    complete = True
+                    break
+                if op == DELTA_COPY:
+                    start = first * block_size
+                    end = min(start + count * block_size, base_size)
+                    if not count or start >= base_size:
+                        raise ProtocolError(f"Delta copies blocks {first}-{first + count} of a {base_size} byte file")
+                    pieces = (os.pread(base_fd, min(MAX_BUFFER_SIZE, end - position), position)
+                              for position in range(start, end, MAX_BUFFER_SIZE))
+                elif op == DELTA_LITERAL:
+                    if count > MAX_LITERAL:
+                        raise ProtocolError(f"Delta literal of {count} bytes is too large")
+                    data = receive_exact(client_socket, count)
+                    literal_bytes += len(data)
+                    if len(data) < count:
+                        break
+                    pieces = [data]
+                else:
+                    raise ProtocolError(f"Unknown delta operation {op!r}")
+                for data in pieces:
+                    written += len(data)
+                    if written > header.size:
+                        raise ProtocolError("Delta is larger than the file")
+                    file_hash.update(data)
+                    f.write(data)
+                    progress.update(len(data))
+        
+        metrics.increment("bytes_received", literal_bytes)
+        metrics.increment("delta_bytes_reused", written - literal_bytes)
+        label = header.algorithm.upper()
+        if complete and written == header.size and file_hash.hexdigest() == header.digest.lower():
+            finish_file(temporary_path, file_path)
+            remember_content(file_path, header.algorithm, header.digest.lower(), storage_root(header.name))
+            remember_latest(header.name, file_path)
+            catalog_file(header, file_path, header.digest.lower(), client_address, started, "delta")
+            logging.info("File %s received successfully from %s as a delta, %s new of %s bytes (%s verified)",
+                         filename, client_address, literal_bytes, header.size, label)
+            metrics.increment("files_received")
+            reply(f"File received successfully - {label} verified")
+        else:
+            error_msg = "Incomplete transfer" if not complete or written != header.size else f"{label} mismatch"
+            metrics.increment("files_failed")
+            logging.warning("File transfer failed from %s: %s", client_address, error_msg)
+            reply(f"File transfer failed: {error_msg}")
+        if complete:
+            os.remove(base_path)
+        return complete
+    finally:
+        os.close(base_fd)
+        progress.close()
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def merge_interval(intervals, start, end):
+    """Sorted, non-overlapping (start, end) intervals with start-end added"""
+    merged = []
+    for first, last in sorted(intervals + [(start, end)]):
+        if merged and first <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def expire_range_transfers():
+    """Drop ranged transfers nobody wrote to for RANGE_EXPIRY seconds, with
+    their open file and preallocated partial file. Needs range_transfers_lock."""
+    now = time.monotonic()
+    for key, transfer in list(range_transfers.items()):
+        if not transfer["writers"] and now - transfer["touched"] > RANGE_EXPIRY:
+            del range_transfers[key]
+            os.close(transfer["fd"])
+            try:
+                os.remove(transfer["path"])
+            except OSError:
+                pass
+            logging.info("Dropped the unfinished ranged transfer %s", key)
+
+def claim_partial(key, client_socket, client_address):
+    """Make this connection the writer of the partial file with key.
+
+    A connection still writing it is most likely left over from an attempt
+    the sender already gave up on, so it is shut down and given TAKEOVER_WAIT
+    seconds to let go. Returns False if it does not.
+    """
+    with active_partials_lock:
+        holder = active_partials.get(key)
+        if holder is None:
+            active_partials[key] = {"socket": client_socket, "released": threading.Event()}
+            return True
+    logging.info("Taking over the transfer %s for %s from an earlier connection", key, client_address)
+    try:
+        holder["socket"].shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    if not holder["released"].wait(TAKEOVER_WAIT):
+        return False
+    with active_partials_lock:
+        if key in active_partials:
+            return False
+        active_partials[key] = {"socket": client_socket, "released": threading.Event()}
+        return True
+
+def expire_partials(partial_directory):
+    """Remove the files of resumable uploads nobody wrote to for PARTIAL_EXPIRY seconds"""
+    cutoff = time.time() - PARTIAL_EXPIRY
+    for entry in os.scandir(partial_directory):
+        key, extension = os.path.splitext(entry.name)
+        if extension not in (".part", ".chunks"):
+            continue
+        # Under the lock, so nobody claims the upload while its files go
+        with active_partials_lock:
+            try:
+                if key not in active_partials and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    logging.info("Dropped the unfinished upload file %s", entry.name)
+            except OSError:
+                pass
+
+def receive_range(client_socket, client_address, header, reply):
+    """Receive one byte range of a file sent over several connections.
+
+    Every range is written in place into a shared file. Once the ranges
+    received cover the whole file and no other connection is still writing
+    into it, the last connection checks the digest of the whole file and
+    moves it into place.
+    """
+    filename = os.path.basename(header.name)
+    filesize = header.size
+    if header.offset < 0 or header.length < 0 or header.offset + header.length > filesize:
+        raise ProtocolError(f"Range {header.offset}+{header.length} is outside a {filesize} byte file")
+    key = transfer_key(filename, filesize, header.digest)
+    with range_transfers_lock:
+        expire_range_transfers()
+        transfer = range_transfers.get(key)
+        if transfer is None:
+            partial_directory = os.path.join(storage_root(filename), PARTIAL_DIRECTORY)
+            os.makedirs(partial_directory, exist_ok=True)
+            part_path = os.path.join(partial_directory, f"{key}.ranges")
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            if not preallocate(fd, filesize):
+                os.ftruncate(fd, filesize)
+            transfer = {"path": part_path, "fd": fd, "covered": [], "ranges": 0, "writers": 0,
+                        "started": time.time(), "touched": time.monotonic()}
+            range_transfers[key] = transfer
+        # The file stays open and unfinished while anyone still writes into it
+        transfer["writers"] += 1
+    
+    bytes_received = 0
+    try:
+        # Acknowledge the header so the range data cannot get mixed into it
+        reply(f"{RANGE}{SEPARATOR}{header.offset}")
+        logging.info("Receiving bytes %s-%s of %s from %s", header.offset, header.offset + header.length, filename, client_address)
+        progress = tqdm.tqdm(range(header.length), f"Receiving {filename} @{header.offset}", unit="B", unit_scale=True, unit_divisor=1024)
+        writer = PositionalWriter(transfer["fd"], header.offset)
+        bytes_received = receive_payload(client_socket, writer, header.length, None, progress)
+        metrics.increment("bytes_received", bytes_received)
+    finally:
+        with range_transfers_lock:
+            transfer["writers"] -= 1
+            transfer["touched"] = time.monotonic()
+            if bytes_received == header.length:
+                # Ranges of earlier attempts may overlap this one, so count bytes covered, not bytes received
+                transfer["covered"] = merge_interval(transfer["covered"], header.offset, header.offset + header.length)
+                transfer["ranges"] += 1
+            covered = sum(end - start for start, end in transfer["covered"])
+            complete = covered >= filesize and not transfer["writers"]
+            if complete:
+                # Only one connection gets to finish the file
+                del range_transfers[key]
+        if complete and bytes_received < header.length:
+            # Earlier ranges already covered this one, nobody else is left to finish the file
+            finish_ranges(transfer, header, client_address)
+    
+    if bytes_received < header.length:
+        logging.warning("Connection with %s closed prematurely", client_address)
+        reply("File transfer failed: Incomplete transfer")
+        return False
+    if not complete:
+        reply(f"Range received ({header.length} bytes)")
+        return True
+    reply(finish_ranges(transfer, header, client_address))
+    return True
+
+def finish_ranges(transfer, header, client_address):
+    """Check the digest of a file whose ranges all arrived and move it into
+    place. Returns the reply for the sender."""
+    os.close(transfer["fd"])
+    filename = os.path.basename(header.name)
+    root = storage_root(filename)
+    file_path = destination_path(filename, session_stamp())
+    filename = os.path.relpath(file_path, root)
+    label = header.algorithm.upper()
+    if file_digest(transfer["path"], header.algorithm) == header.digest:
+        finish_file(transfer["path"], file_path)
+        remember_content(file_path, header.algorithm, header.digest, root)
+        remember_latest(os.path.basename(header.name), file_path)
+        catalog_file(header, file_path, header.digest, client_address, transfer["started"], "ranges")
+        logging.info("File %s received successfully in %s ranges (%s verified)", filename, transfer["ranges"], label)
+        metrics.increment("files_received")
+        return f"File received successfully - {label} verified"
+    os.remove(transfer["path"])
+    metrics.increment("files_failed")
+    metrics.increment("digest_mismatches")
+    logging.warning("File transfer failed from %s: %s mismatch", client_address, label)
+    return f"File transfer failed: {label} mismatch"
+
+class StagedWriter:
+    """Hashes and writes received buffers on two threads of their own.
+
+    Buffers go round a fixed pool: the connection thread fills a free one,
+    the hasher updates the digest with it, the writer writes it to disk and
+    hands it back. A slow disk only blocks the connection thread once every
+    buffer is waiting for the writer. hashlib and file writes release the
+    GIL on large buffers, so all three stages really run at once.
+    """
+
+    def __init__(self, f, file_hash, chunk_log, depth):
+        self.f = f
+        self.file_hash = file_hash
+        self.chunk_log = chunk_log
+        self.error = None
+        self.hash_time = 0.0
+        self.write_time = 0.0
+        self.free = queue.Queue()
+        for _ in range(depth):
+            self.free.put(bytearray(PIPELINE_BUFFER_SIZE))
+        self.to_hash = queue.Queue(depth)
+        self.to_write = queue.Queue(depth)
+        self.threads = [threading.Thread(target=self.hash_stage, daemon=True),
+                        threading.Thread(target=self.write_stage, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def buffer(self):
+        """Return a free buffer, waiting while all of them are in use"""
+        buffer = self.free.get()
+        if self.error:
+            raise self.error
+        return buffer
+
+    def submit(self, buffer, nbytes):
+        """Queue the first nbytes of buffer for hashing and writing"""
+        self.to_hash.put((buffer, nbytes))
+
+    def hash_stage(self):
+        while True:
+            item = self.to_hash.get()
+            if item and not self.error:
+                data = memoryview(item[0])[:item[1]]
+                try:
+                    started = time.perf_counter()
+                    if self.file_hash:
+                        self.file_hash.update(data)
+                    if self.chunk_log:
+                        self.chunk_log.update(data)
+                    self.hash_time += time.perf_counter() - started
+                except Exception as e:
+                    self.error = e
+            # Failed buffers still go on, so they find their way back to the pool
+            self.to_write.put(item)
+            if item is None:
+                return
+
+    def write_stage(self):
+        while True:
+            item = self.to_write.get()
+            if item is None:
+                return
+            if not self.error:
+                try:
+                    started = time.perf_counter()
+                    self.f.write(memoryview(item[0])[:item[1]])
+                    self.write_time += time.perf_counter() - started
+                except Exception as e:
+                    self.error = e
+            self.free.put(item[0])
+
+    def close(self):
+        """Wait until everything queued is hashed and written"""
+        self.to_hash.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise self.error
+
+def receive_staged(client_socket, f, filesize, file_hash, progress, chunk_log=None):
+    """receive_payload() with hashing and writing on their own threads.
+
+    Each buffer is filled completely before it is handed on, so the other
+    stages see a few large buffers instead of every small read.
+    """
+    stages = StagedWriter(f, file_hash, chunk_log, PIPELINE_DEPTH)
+    bytes_received = 0
+    try:
+        while bytes_received < filesize:
+            buffer = stages.buffer()
+            view = memoryview(buffer)[:min(len(buffer), filesize - bytes_received)]
+            filled = 0
+            while filled < len(view):
+                nbytes = client_socket.recv_into(view[filled:])
+                if not nbytes:
+                    break
+                filled += nbytes
+                progress.update(nbytes)
+            stages.submit(buffer, filled)
+            bytes_received += filled
+            if filled < len(view):
+                break
+    finally:
+        stages.close()
+        observe_stage_times(stages.hash_time, stages.write_time)
+    return bytes_received
+
+def receive_payload(client_socket, f, filesize, file_hash, progress, chunk_log=None):
+    """Receive filesize bytes into f and return how many actually arrived.
+
+    One buffer is reused for every recv_into() call. Whenever a read fills
+    the whole chunk the sender is outpacing us, so the chunk doubles (up to
+    MAX_BUFFER_SIZE) to cut the number of calls per megabyte.
+    """
+    if PIPELINE_DEPTH:
+        return receive_staged(client_socket, f, filesize, file_hash, progress, chunk_log)
+    chunk_size = BUFFER_SIZE
+    buffer = memoryview(bytearray(chunk_size))
+    bytes_received = 0
+    hash_time = write_time = 0.0
+    while bytes_received < filesize:
+        # Never read past the end of this file
+        wanted = min(chunk_size, filesize - bytes_received)
+        nbytes = client_socket.recv_into(buffer[:wanted])
+        if not nbytes:
+            break
+        data = buffer[:nbytes]
+        # Update the digest
+        started = time.perf_counter()
+        if file_hash:
+            file_hash.update(data)
+        if chunk_log:
+            chunk_log.update(data)
+        hashed = time.perf_counter()
+        # Write to file and update progress
+        f.write(data)
+        written = time.perf_counter()
+        hash_time += hashed - started
+        write_time += written - hashed
+        bytes_received += nbytes
+        progress.update(nbytes)
+        if nbytes == chunk_size and chunk_size < MAX_BUFFER_SIZE:
+            chunk_size = min(chunk_size * 2, MAX_BUFFER_SIZE)
+            buffer = memoryview(bytearray(chunk_size))
+    observe_stage_times(hash_time, write_time)
+    return bytes_received
+
+def observe_stage_times(hash_time, write_time):
+    """Record how long one transfer spent hashing and writing"""
+    metrics.observe("hash_seconds", hash_time)
+    metrics.observe("write_seconds", write_time)
+
+def decompress_chunk(decompressor, data):
+    """Yield the output of one compressed chunk in pieces of at most
+    MAX_BUFFER_SIZE, so a small chunk cannot blow up in memory"""
+    if hasattr(decompressor, "unconsumed_tail"):
+        # zlib keeps the input it did not get to
+        while data:
+            yield decompressor.decompress(data, MAX_BUFFER_SIZE)
+            data = decompressor.unconsumed_tail
+    else:
+        # lzma and bz2 keep it internally
+        yield decompressor.decompress(data, max_length=MAX_BUFFER_SIZE)
+        while not decompressor.needs_input and not decompressor.eof:
+            yield decompressor.decompress(b"", max_length=MAX_BUFFER_SIZE)
+
+def receive_compressed(client_socket, f, filesize, file_hash, progress, codec, chunk_log=None):
+    """Receive length-prefixed compressed chunks until the empty one and
+    return how many bytes they decompressed to. The digest covers the
+    decompressed data, the same bytes the sender hashed."""
+    decompressor = DECOMPRESSORS[codec]()
+    bytes_received = 0
+    hash_time = write_time = 0.0
+    try:
+        while True:
+            prefix = receive_exact(client_socket, CHUNK_LENGTH.size)
+            if len(prefix) < CHUNK_LENGTH.size:
+                return bytes_received
+            (length,) = CHUNK_LENGTH.unpack(prefix)
+            if not length:
+                break
+            if length > MAX_COMPRESSED_CHUNK:
+                raise ProtocolError(f"Compressed chunk of {length} bytes is too large")
+            compressed = receive_exact(client_socket, length)
+            if len(compressed) < length:
+                return bytes_received
+            for data in decompress_chunk(decompressor, compressed):
+                bytes_received += len(data)
+                if bytes_received > filesize:
+                    raise ProtocolError("Compressed data is larger than the file")
+                started = time.perf_counter()
+                file_hash.update(data)
+                if chunk_log:
+                    chunk_log.update(data)
+                hashed = time.perf_counter()
+                f.write(data)
+                hash_time += hashed - started
+                write_time += time.perf_counter() - hashed
+                progress.update(len(data))
+        if hasattr(decompressor, "flush"):
+            data = decompressor.flush()
+            file_hash.update(data)
+            f.write(data)
+            if chunk_log:
+                chunk_log.update(data)
+            bytes_received += len(data)
+        return bytes_received
+    finally:
+        observe_stage_times(hash_time, write_time)
+
+class TokenBucket:
+    """Token bucket holding up to BURST_SECONDS of its rate.
+
+    reserve() always takes the tokens, even when the bucket runs into debt,
+    and returns how long the caller has to wait for them. While the bucket
+    is not empty it costs no waiting at all.
+    """
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = max(int(rate * BURST_SECONDS), MIN_BURST)
+
+    def reserve(self, nbytes):
+        """Take nbytes tokens and return the seconds until they are covered"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class ThrottledSocket:
+    """Client socket whose reads are paced by the global, per-client and
+    fair-share token buckets. Everything but recv() and recv_into() goes
+    straight to the real socket.
+
+    Buckets are per client IP, so a client cannot get around its limit or
+    its share by opening more connections.
+    """
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client = client_address[0]
+        global global_bucket
+        with throttle_lock:
+            if RATE_LIMIT and global_bucket is None:
+                global_bucket = TokenBucket(RATE_LIMIT)
+            if CLIENT_RATE_LIMIT and self.client not in client_buckets:
+                client_buckets[self.client] = TokenBucket(CLIENT_RATE_LIMIT)
+            if RATE_LIMIT and FAIR_SHARE and self.client not in fair_buckets:
+                fair_buckets[self.client] = TokenBucket(RATE_LIMIT)
+            throttled_connections[self.client] += 1
+            self.fair_bucket = fair_buckets.get(self.client)
+            self.buckets = [bucket for bucket in (global_bucket, client_buckets.get(self.client), self.fair_bucket) if bucket]
+        self.max_read = min(bucket.capacity for bucket in self.buckets)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def pace(self, nbytes):
+        """Charge nbytes to every bucket and sleep for the slowest one"""
+        if self.fair_bucket:
+            # The global rate is split between the clients that read recently, idle ones take nothing
+            now = time.monotonic()
+            with throttle_lock:
+                last_reads[self.client] = now
+                readers = sum(1 for last_read in last_reads.values() if now - last_read < ACTIVE_WINDOW)
+            self.fair_bucket.set_rate(RATE_LIMIT / readers)
+        # Never read more than the smallest bucket holds, so pauses stay short
+        self.max_read = min(bucket.capacity for bucket in self.buckets)
+        delay = max(bucket.reserve(nbytes) for bucket in self.buckets)
+        if delay:
+            time.sleep(delay)
+
+    def recv(self, size, *args):
+        data = self.sock.recv(min(size, self.max_read), *args)
+        if data:
+            self.pace(len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes=0, *args):
+        nbytes = self.sock.recv_into(buffer, min(nbytes or len(buffer), self.max_read), *args)
+        if nbytes:
+            self.pace(nbytes)
+        return nbytes
+
+    def close(self):
+        with throttle_lock:
+            throttled_connections[self.client] -= 1
+            if not throttled_connections[self.client]:
+                # Last connection of this client, forget its buckets
+                del throttled_connections[self.client]
+                client_buckets.pop(self.client, None)
+                fair_buckets.pop(self.client, None)
+                last_reads.pop(self.client, None)
+        self.sock.close()
+
+def receive_exact(client_socket, size):
+    """Read exactly size bytes, or fewer if the connection closes first"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+def parse_legacy_header(received):
+    """Turn a text header, filename<SEPARATOR>filesize<SEPARATOR>md5 plus
+    optional fields, into a FileHeader"""
+    filename, filesize, expected_digest, *options = received.split(SEPARATOR)
+    header = FileHeader(filename, int(filesize), expected_digest)
+    if expected_digest == TRAILER:
+        header.flags |= FLAG_TRAILER
+        header.digest = ""
+        header.digest_length = 32
+    if options[:1] == [RANGE]:
+        header.flags |= FLAG_RANGE
+        header.offset, header.length = int(options[1]), int(options[2])
+    if RESUME in options:
+        header.flags |= FLAG_RESUME
+    return header
+
+def name_parts(name):
+    """Split a sent file name into safe path components"""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    if not parts:
+        raise ProtocolError(f"Invalid file name {name!r}")
+    return parts
+
+def storage_roots():
+    """The save directory and the extra roots, in order"""
+    return [SAVE_DIRECTORY, *EXTRA_ROOTS]
+
+def storage_root(name):
+    """Root a sent file name is stored under.
+
+    The root is picked by a hash of the name's first component, so every
+    copy of a name, and every file of a directory sent as a whole, lands on
+    the same root. Its partial files, delta bases and links then stay on
+    one file system and can be renamed and hard-linked.
+    """
+    if not EXTRA_ROOTS:
+        return SAVE_DIRECTORY
+    roots = storage_roots()
+    key = hashlib.md5(name_parts(name)[0].encode()).digest()
+    return roots[int.from_bytes(key[:4], "big") % len(roots)]
+
+def shard_directories(timestamp, stored_name):
+    """Sub-directories of a root that a stored name goes into.
+
+    "date" makes one directory per hour, "hash" spreads names evenly over
+    65536 directories by a hash of the stored name. Either way no directory
+    grows with the whole store, so creating and looking up a name stays
+    fast however many files were received.
+    """
+    if STORAGE_LAYOUT == "date":
+        return [timestamp[:4], timestamp[4:6], timestamp[6:8], timestamp[9:11]]
+    if STORAGE_LAYOUT == "hash":
+        key = hashlib.md5(stored_name.encode()).hexdigest()
+        return [key[:2], key[2:4]]
+    return []
+
+def session_stamp():
+    """Timestamp shared by the files of one session, unique in this process.
+
+    Sessions starting in the same second get a counter appended, e.g.
+    20240101_120000-1, so their files never overwrite each other.
+    """
+    global last_stamp, stamp_repeats
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    with stamp_lock:
+        if stamp != last_stamp:
+            last_stamp, stamp_repeats = stamp, 0
+            return stamp
+        stamp_repeats += 1
+        return f"{stamp}-{stamp_repeats}"
+
+def latest_path(name):
+    """Where the newest copy of a file name is linked"""
+    return os.path.join(storage_root(name), LATEST_DIRECTORY, *name_parts(name))
+
+def remember_latest(name, file_path):
+    """Link file_path as the newest copy of name, the base of the next delta upload"""
+    path = latest_path(name)
+    try:
+        # A file and a directory of the same name cannot both be remembered,
+        # that must never fail a transfer that is already stored
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_content(file_path, path)
+    except OSError as e:
+        logging.warning("Cannot remember %s as the latest %s: %s", file_path, name, e)
+
+def destination_path(name, timestamp):
+    """Where a received file is stored.
+
+    A plain name becomes {timestamp}_{name} in the shard directories of
+    its root. A relative path such as build/bin/app keeps its directories
+    under {timestamp}_build, so a directory sent in one session is
+    recreated as a whole. A name the session already used gets a counter,
+    e.g. {timestamp}_report.1.txt, instead of replacing the earlier file.
+    """
+    parts = name_parts(name)
+    parts[0] = f"{timestamp}_{parts[0]}"
+    directory = os.path.join(storage_root(name), *shard_directories(timestamp, parts[0]), *parts[:-1])
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, parts[-1])
+    stem, extension = os.path.splitext(parts[-1])
+    copies = itertools.count(1)
+    while os.path.exists(file_path):
+        file_path = os.path.join(directory, f"{stem}.{next(copies)}{extension}")
+    return file_path
+
+def receive_header(client_socket, received=b""):
+    """Read the next frame header, name and digest included.
+
+    Returns None when the sender closed the connection between files.
+    """
+    data = received + receive_exact(client_socket, HEADER.size - len(received))
+    if not data:
+        return None
+    if len(data) < HEADER.size:
+        raise ProtocolError("Connection closed inside a frame header")
+    header, name_length = unpack_header(data)
+    header.name = receive_exact(client_socket, name_length).decode()
+    if not header.flags & FLAG_TRAILER:
+        header.digest = receive_exact(client_socket, header.digest_length).decode()
+    return header
+
+def receive_file(client_socket, client_address, header, reply, timestamp=None):
+    """Receive the file described by header and answer through reply().
+
+    Files of one session share its timestamp. Returns False when the data
+    stopped early, the connection cannot carry any more files after that.
+    """
+    if header.codec not in (CODEC_NONE, *DECOMPRESSORS):
+        raise ProtocolError(f"Unknown compression codec {header.codec}")
+    # Timestamp for unique file names, shared by the files of one session
+    timestamp = timestamp or session_stamp()
+    started_at = time.time()
+    if header.flags & FLAG_QUERY:
+        # Only the digest, the data follows in another frame if needed
+        answer_query(client_socket, client_address, header, reply, timestamp)
+        return True
+    if header.flags & FLAG_DELTA:
+        # Differences to the previous copy, after a delta query
+        if header.codec != CODEC_NONE or header.flags & (FLAG_RANGE | FLAG_RESUME | FLAG_TRAILER):
+            raise ProtocolError("Deltas cannot be compressed, resumed, split or streamed")
+        return receive_delta(client_socket, client_address, header, reply, timestamp)
+    if header.flags & FLAG_RANGE:
+        # One part of a file sent over several connections
+        if header.codec != CODEC_NONE:
+            raise ProtocolError("Byte ranges cannot be compressed")
+        return receive_range(client_socket, client_address, header, reply)
+    
+    filename = header.name
+    filesize = header.size
+    expected_digest = header.digest
+    resume_key = None
+    temporary_path = None
+    try:
+        if header.flags & FLAG_RESUME:
+            # Resumable transfers are identified by name, size and digest
+            resume_key = transfer_key(filename, filesize, expected_digest)
+            if not claim_partial(resume_key, client_socket, client_address):
+                logging.warning("Transfer of %s from %s is already in progress", filename, client_address)
+                reply("File transfer failed: Transfer already in progress")
+                resume_key = None
+                return False
+            partial_directory = os.path.join(storage_root(filename), PARTIAL_DIRECTORY)
+            os.makedirs(partial_directory, exist_ok=True)
+            expire_partials(partial_directory)
+            part_path = os.path.join(partial_directory, f"{resume_key}.part")
+            log_path = os.path.join(partial_directory, f"{resume_key}.chunks")
+            # Tell the sender where to continue from
+            offset, file_hash = verify_partial(part_path, log_path, header.algorithm)
+            reply(f"{RESUME}{SEPARATOR}{offset}")
+        else:
+            part_path = None
+            offset = 0
+            file_hash = hashlib.new(header.algorithm)
+        
         # Full path to save the file
-        file_path = os.path.join(SAVE_DIRECTORY, filename)
-        # Convert to integer
-        filesize = int(filesize)
+        file_path = destination_path(filename, timestamp)
+        filename = os.path.relpath(file_path, storage_root(header.name))
+        # The file only gets its real name once it is verified
+        temporary_path = part_path or f"{file_path}.tmp"
         
-        logging.info(f"Receiving file: {filename} ({filesize} bytes) from {client_address}")
+        if offset:
+            logging.info("Resuming file: %s at byte %s of %s from %s", filename, offset, filesize, client_address)
+        else:
+            logging.info("Receiving file: %s (%s bytes) from %s", filename, filesize, client_address)
         
         # Start receiving the file
-        md5_hash = hashlib.md5()
-        progress = tqdm.tqdm(range(filesize), f"Receiving {filename}", unit="B", unit_scale=True, unit_divisor=1024)
-        with open(file_path, "wb") as f:
-            bytes_received = 0
-            while bytes_received < filesize:
-                # Read bytes from socket
-                bytes_read = client_socket.recv(BUFFER_SIZE)
-                if not bytes_read:    
+        progress = tqdm.tqdm(range(filesize), f"Receiving {filename}", unit="B", unit_scale=True, unit_divisor=1024,
+                             initial=offset, disable=filesize < PROGRESS_MIN_SIZE)
+        chunk_log = ChunkLog(log_path, header.algorithm) if part_path else None
+        metrics.adjust("active_transfers", 1)
+        started = time.perf_counter()
+        try:
+            with open(temporary_path, "ab" if part_path else "wb") as f:
+                if not part_path:
+                    # Appending to a partial file needs its size to stay as it is
+                    preallocate(f.fileno(), filesize)
+                if header.codec == CODEC_NONE:
+                    bytes_received = offset + receive_payload(client_socket, f, filesize - offset, file_hash, progress, chunk_log)
+                else:
+                    bytes_received = offset + receive_compressed(client_socket, f, filesize - offset, file_hash, progress, header.codec, chunk_log)
+                if bytes_received < filesize:
                     # Connection closed prematurely
-                    logging.warning(f"Connection with {client_address} closed prematurely")
-                    break
-                # Update MD5 hash
-                md5_hash.update(bytes_read)
-                # Write to file and update progress
-                f.write(bytes_read)
-                bytes_received += len(bytes_read)
-                progress.update(len(bytes_read))
+                    logging.warning("Connection with %s closed prematurely", client_address)
+                elif header.flags & FLAG_TRAILER:
+                    # Streaming sender: the digest follows the file data
+                    expected_digest = receive_exact(client_socket, header.digest_length).decode()
+        finally:
+            progress.close()
+            if chunk_log:
+                chunk_log.close()
+            metrics.adjust("active_transfers", -1)
+        elapsed = time.perf_counter() - started
+        metrics.increment("bytes_received", bytes_received - offset)
+        metrics.observe("transfer_seconds", elapsed)
+        if elapsed > 0 and bytes_received > offset:
+            metrics.observe("transfer_mb_per_second", (bytes_received - offset) / 1e6 / elapsed, MB_PER_SECOND_BUCKETS)
         
         # Verify file integrity
-        calculated_md5 = md5_hash.hexdigest()
-        if bytes_received == filesize and calculated_md5 == expected_md5:
-            logging.info(f"File {filename} received successfully from {client_address} (MD5 verified)")
-            client_socket.send("File received successfully - MD5 verified".encode())
+        calculated_digest = file_hash.hexdigest()
+        label = header.algorithm.upper()
+        if bytes_received == filesize and calculated_digest == expected_digest.lower():
+            finish_file(temporary_path, file_path)
+            if part_path:
+                os.remove(log_path)
+            remember_content(file_path, header.algorithm, calculated_digest, storage_root(header.name))
+            remember_latest(header.name, file_path)
+            catalog_file(header, file_path, calculated_digest, client_address, started_at, "resume" if offset else "upload")
+            logging.info("File %s received successfully from %s (%s verified)", filename, client_address, label)
+            metrics.increment("files_received")
+            reply(f"File received successfully - {label} verified")
         else:
-            error_msg = "Incomplete transfer" if bytes_received != filesize else "MD5 mismatch"
-            logging.warning(f"File transfer failed from {client_address}: {error_msg}")
-            client_socket.send(f"File transfer failed: {error_msg}".encode())
+            error_msg = "Incomplete transfer" if bytes_received != filesize else f"{label} mismatch"
+            metrics.increment("files_failed")
+            if bytes_received == filesize:
+                metrics.increment("digest_mismatches")
+            if part_path and bytes_received == filesize:
+                # A complete but corrupt file cannot be resumed, start over next time
+                os.remove(part_path)
+                os.remove(log_path)
+            elif part_path:
+                logging.info("Keeping partial file for %s, %s of %s bytes", filename, bytes_received, filesize)
+            logging.warning("File transfer failed from %s: %s", client_address, error_msg)
+            reply(f"File transfer failed: {error_msg}")
+        return bytes_received == filesize
+    finally:
+        if temporary_path and not part_path and os.path.exists(temporary_path):
+            # Failed, never leave a half file behind
+            os.remove(temporary_path)
+        if resume_key:
+            with active_partials_lock:
+                active_partials.pop(resume_key)["released"].set()
+
+def handle_connection(client_socket, client_address):
+    """Serve one client: either a single file with a text header, or any
+    number of binary frames back-to-back"""
+    if RATE_LIMIT or CLIENT_RATE_LIMIT:
+        client_socket = ThrottledSocket(client_socket, client_address)
+    metrics.increment("connections")
+    metrics.adjust("open_connections", 1)
+    log_context.sampled = next(connection_counter) % LOG_SAMPLE == 0
+    try:
+        client_socket.settimeout(CLIENT_TIMEOUT)
+        accepted = time.perf_counter()
+        received = receive_exact(client_socket, len(MAGIC))
+        metrics.observe("time_to_first_byte_seconds", time.perf_counter() - accepted)
+        if not received:
+            logging.warning("Client %s connected but sent no data", client_address)
+            return
+        
+        if received != MAGIC:
+            # Text protocol: the rest of the header, then one file
+            received += client_socket.recv(BUFFER_SIZE)
+            header = parse_legacy_header(received.decode())
+            # Remove absolute path if there is
+            header.name = os.path.basename(header.name)
+            receive_file(client_socket, client_address, header, lambda message: client_socket.send(message.encode()))
+            return
+        
+        # Binary frames, every reply is one line so the sender can pipeline
+        def reply(message):
+            client_socket.sendall(f"{message}\n".encode())
+        
+        files = 0
+        timestamp = session_stamp()
+        try:
+            header = receive_header(client_socket, received)
+            while header:
+                if not receive_file(client_socket, client_address, header, reply, timestamp):
+                    break
+                files += 1
+                header = receive_header(client_socket)
+        except ProtocolError as e:
+            # Tell the sender why, the stream cannot be followed any further
+            metrics.increment("protocol_errors")
+            logging.warning("Protocol error from %s: %s", client_address, e)
+            reply(f"File transfer failed: {str(e)}")
+        logging.info("Received %s file(s) from %s", files, client_address)
             
     except Exception as e:
-        logging.error(f"Error receiving file from {client_address}: {str(e)}")
+        metrics.increment("connection_errors")
+        logging.error("Error receiving file from %s: %s", client_address, e)
     finally:
         # Close the client socket
         client_socket.close()
-        logging.info(f"Connection with {client_address} closed")
+        metrics.adjust("open_connections", -1)
+        logging.info("Connection with %s closed", client_address)
+        log_context.sampled = True
+
+def handle_client(client_socket, client_address, slots):
+    """Worker thread entry point: serve the connection, then free its admission slot"""
+    metrics.adjust("queued_connections", -1)
+    try:
+        handle_connection(client_socket, client_address)
+    finally:
+        slots.release()
+
+class BusyRejecter:
+    """Turns clients away from the accept loop itself while there is no room.
+
+    The busy line is sent without blocking, a new socket always has room
+    for it, and it is the only thing sent. Whatever the client already
+    sent is then read and thrown away for up to REJECT_LINGER seconds,
+    because closing a socket with unread data resets the connection and
+    the client could lose the busy line. Reading happens whenever the
+    accept loop's selector finds a rejected socket readable, so a slow
+    client never delays the busy line of the next one.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.draining = {}  # Rejected sockets and when they are closed at the latest, oldest first
+
+    def reject(self, client_socket):
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(f"{BUSY}{SEPARATOR}{BUSY_RETRY_AFTER}\n".encode())
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            client_socket.close()
+            return
+        if len(self.draining) >= MAX_DRAINING:
+            # No room to wait for it either, the busy line may still get through
+            client_socket.close()
+            return
+        self.draining[client_socket] = time.monotonic() + REJECT_LINGER
+        self.selector.register(client_socket, selectors.EVENT_READ)
 
-def start_server():
+    def drain(self, client_socket):
+        """Throw away what a rejected client sent, close it once it hung up"""
+        try:
+            if client_socket.recv(DRAIN_CHUNK):
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            pass
+        self.close(client_socket)
+
+    def timeout(self):
+        """Seconds until the oldest rejected socket is due to be closed, None without any"""
+        if not self.draining:
+            return None
+        return max(0, next(iter(self.draining.values())) - time.monotonic())
+
+    def expire(self):
+        """Close the rejected sockets whose REJECT_LINGER is over"""
+        now = time.monotonic()
+        for client_socket, deadline in list(self.draining.items()):
+            if deadline > now:
+                break
+            self.close(client_socket)
+
+    def close(self, client_socket=None):
+        """Close one rejected socket, or all of them"""
+        for s in [client_socket] if client_socket else list(self.draining):
+            self.selector.unregister(s)
+            del self.draining[s]
+            s.close()
+
+def start_server(workers=WORKERS, queue_size=QUEUE_SIZE):
     """Start the file receiver service"""
     # Create the server socket (TCP)
     server_socket = socket.socket()
@@ -96,39 +1349,136 @@ def start_server():
     # Enable address reuse to avoid "Address already in use" after restart
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
+    # Bounded pool of worker threads, one transfer per worker. Admitted
+    # clients beyond that wait in the pool's queue, up to queue_size of them
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="receiver")
+    slots = threading.BoundedSemaphore(workers + queue_size)
+    # The accept loop waits for new connections and for rejected clients to hang up
+    selector = selectors.DefaultSelector()
+    rejecter = BusyRejecter(selector)
+    
     try:
         # Bind the socket to our local address
         server_socket.bind((SERVER_HOST, SERVER_PORT))
         # Enable server to accept connections
-        server_socket.listen(5)
-        logging.info(f"Server started - listening on {SERVER_HOST}:{SERVER_PORT}")
+        server_socket.listen(LISTEN_BACKLOG)
+        logging.info("Server started - listening on %s:%s", SERVER_HOST, SERVER_PORT)
         print(f"[*] File receiver service started - listening on {SERVER_HOST}:{SERVER_PORT}")
-        print(f"[*] Files will be saved to: {os.path.abspath(SAVE_DIRECTORY)}")
+        print(f"[*] Files will be saved to: {', '.join(os.path.abspath(root) for root in storage_roots())} ({STORAGE_LAYOUT} layout)")
+        print(f"[*] Handling up to {workers} transfer(s) at once, {queue_size} more may wait")
         print(f"[*] Press Ctrl+C to stop the service")
         
         # Ensure save directory exists
         ensure_save_directory()
+        if FSYNC_POLICY == "batch":
+            threading.Thread(target=sync_batches_periodically, daemon=True).start()
         
         # Main service loop
+        selector.register(server_socket, selectors.EVENT_READ)
         while True:
-            # Accept connection
-            client_socket, client_address = server_socket.accept()
-            print(f"[+] Connection from {client_address}")
-            
-            # Handle file reception in a separate function
-            receive_file(client_socket, client_address)
+            ready = selector.select(rejecter.timeout())
+            rejecter.expire()
+            for key, _ in ready:
+                if key.fileobj is not server_socket:
+                    if key.fileobj in rejecter.draining:
+                        rejecter.drain(key.fileobj)
+                    continue
+                # Accept connection
+                client_socket, client_address = server_socket.accept()
+                if not slots.acquire(blocking=False):
+                    # Every worker is busy and the wait queue is full: answer
+                    # right away instead of letting the client time out
+                    metrics.increment("connections_rejected")
+                    logging.info("Turned away %s, the receiver is busy", client_address)
+                    rejecter.reject(client_socket)
+                    continue
+                print(f"[+] Connection from {client_address}")
+                
+                # Handle file reception on a worker thread, or wait for one
+                metrics.adjust("queued_connections", 1)
+                pool.submit(handle_client, client_socket, client_address, slots)
             
     except KeyboardInterrupt:
         print("\n[!] Server shutdown requested")
         logging.info("Server shutdown requested")
     except Exception as e:
-        logging.error(f"Server error: {str(e)}")
+        logging.error("Server error: %s", e)
         print(f"[!] Server error: {str(e)}")
     finally:
-        # Close the server socket
+        # Close the server socket and let in-flight transfers finish
         server_socket.close()
+        pool.shutdown(wait=True)
+        rejecter.close()
+        selector.close()
+        sync_unsynced_files(force=True)
         logging.info("Server stopped")
         print("[*] Server stopped")
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="File Receiver Service")
+    parser.add_argument("-p", "--port", help=f"Port to listen on, default is {SERVER_PORT}", type=int, default=SERVER_PORT)
+    parser.add_argument("-d", "--save-dir", help=f"Directory to save files in, default is {SAVE_DIRECTORY}", default=SAVE_DIRECTORY)
+    parser.add_argument("--root", help="Another directory, e.g. on a different disk, to spread received files over; may be repeated",
+                        action="append", default=[])
+    parser.add_argument("--layout", help=f"How files are arranged in a root: all in one directory, by hour or by hash (default is {STORAGE_LAYOUT})",
+                        choices=["flat", "date", "hash"], default=STORAGE_LAYOUT)
+    parser.add_argument("-q", "--queue", help=f"Clients that may wait for a free worker, more get a busy reply, default is {QUEUE_SIZE}",
+                        type=int, default=QUEUE_SIZE)
+    parser.add_argument("--backlog", help=f"Listen backlog of the server socket, default is {LISTEN_BACKLOG}", type=int, default=LISTEN_BACKLOG)
+    parser.add_argument("--retry-after", help=f"Seconds busy clients are told to wait, default is {BUSY_RETRY_AFTER}",
+                        type=int, default=BUSY_RETRY_AFTER)
+    parser.add_argument("-b", "--buffer-size", help=f"Bytes of the first recv_into() of a file, default is {BUFFER_SIZE}", type=int, default=BUFFER_SIZE)
+    parser.add_argument("--max-buffer-size", help=f"Bytes the receive buffer may grow to, default is {MAX_BUFFER_SIZE}", type=int, default=MAX_BUFFER_SIZE)
+    parser.add_argument("-w", "--workers", help=f"Number of transfers handled at once, default is {WORKERS} (sequential)", type=int, default=WORKERS)
+    parser.add_argument("--pipeline", help="Receive, hash and write on separate threads with this many 1 MiB buffers in flight, default is 0 (in series)",
+                        type=int, default=PIPELINE_DEPTH)
+    parser.add_argument("--rate", help="MB/s all uploads together may use, default is unlimited", type=float, default=0)
+    parser.add_argument("--client-rate", help="MB/s the uploads of one client IP may use, default is unlimited", type=float, default=0)
+    parser.add_argument("--fair", help="Give every client IP that is sending an equal share of --rate", action="store_true")
+    parser.add_argument("--fsync", help=f"When received files are synced to disk: after every file, in batches or never (default is {FSYNC_POLICY})",
+                        choices=["file", "batch", "never"], default=FSYNC_POLICY)
+    parser.add_argument("--fsync-files", help=f"With --fsync batch, sync once this many files are waiting, default is {FSYNC_BATCH_FILES}",
+                        type=int, default=FSYNC_BATCH_FILES)
+    parser.add_argument("--fsync-seconds", help=f"With --fsync batch, sync files waiting this long, default is {FSYNC_BATCH_SECONDS}",
+                        type=float, default=FSYNC_BATCH_SECONDS)
+    parser.add_argument("--log-sample", help=f"Log the INFO lines of every Nth connection only, default is {LOG_SAMPLE} (all)",
+                        type=int, default=LOG_SAMPLE)
+    parser.add_argument("--catalog", help=f"SQLite catalog of every stored file, default is SAVE_DIR/{CATALOG_FILE}")
+    parser.add_argument("--no-catalog", help="Do not record stored files in a catalog", action="store_true")
+    parser.add_argument("--metrics-port", help="Serve live metrics as JSON on http://127.0.0.1:PORT/metrics", type=int)
+    args = parser.parse_args()
+    if args.rate < 0 or args.client_rate < 0:
+        parser.error("--rate and --client-rate cannot be negative")
+    if args.fair and not args.rate:
+        parser.error("--fair shares --rate, which is not set")
+    SERVER_PORT = args.port
+    RATE_LIMIT = args.rate * 1e6
+    CLIENT_RATE_LIMIT = args.client_rate * 1e6
+    FAIR_SHARE = args.fair
+    FSYNC_POLICY = args.fsync
+    LOG_SAMPLE = max(1, args.log_sample)
+    LISTEN_BACKLOG = max(1, args.backlog)
+    BUSY_RETRY_AFTER = max(0, args.retry_after)
+    FSYNC_BATCH_FILES = max(1, args.fsync_files)
+    FSYNC_BATCH_SECONDS = args.fsync_seconds
+    if args.metrics_port:
+        serve_metrics(metrics, args.metrics_port)
+        print(f"[*] Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    PIPELINE_DEPTH = max(0, args.pipeline)
+    SAVE_DIRECTORY = args.save_dir
+    EXTRA_ROOTS = [root for root in args.root if os.path.abspath(root) != os.path.abspath(SAVE_DIRECTORY)]
+    STORAGE_LAYOUT = args.layout
+    BUFFER_SIZE = max(1, args.buffer_size)
+    MAX_BUFFER_SIZE = max(BUFFER_SIZE, args.max_buffer_size)
+    log_listener = setup_logging()
+    if not args.no_catalog:
+        catalog_path = args.catalog or os.path.join(SAVE_DIRECTORY, CATALOG_FILE)
+        os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+        catalog = Catalog(catalog_path)
+    try:
+        start_server(max(1, args.workers), max(0, args.queue))
+    finally:
+        # Write out whatever is still queued
+        if catalog:
+            catalog.close()
+        log_listener.stop()
@@ -1,68 +1,845 @@
 """
-Client that sends the file (uploads)
+Client that sends files (uploads)
 """
 import socket
 import tqdm
 import os
 import argparse
 import hashlib
+import time
+import threading
+import zlib
+import lzma
+import bz2
+import mmap
+import select
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from transfer_protocol import (DIGEST_ALGORITHMS, FLAG_TRAILER, FLAG_RESUME, FLAG_RANGE, FLAG_QUERY, FLAG_DELTA, NEED, DELTA, BUSY,
+                               CODEC_NONE, CODEC_NAMES, CODEC_ZLIB, CODEC_LZMA, CODEC_BZ2, CHUNK_LENGTH, SIGNATURE, DELTA_OP,
+                               DELTA_COPY, DELTA_LITERAL, DELTA_END, FileHeader, pack_header, strong_checksum)
 
-SEPARATOR = "<SEPARATOR>"
+SEPARATOR = "<SEPARATOR>"  # Separates the fields of RESUME and RANGE replies
 BUFFER_SIZE = 4096
+SENDFILE_CHUNK = 8 * 1024 * 1024  # Bytes handed to sendfile() per call
+STREAM_CHUNK = 1024 * 1024  # Bytes read per chunk when hashing while sending
+RESUME = "RESUME"  # Reply with the offset to continue an interrupted transfer from
+RANGE = "RANGE"  # Reply accepting one byte range of a file
+MIN_RANGE_SIZE = 1024 * 1024  # Files are never split into ranges smaller than this
+SMALL_FILE_SIZE = 64 * 1024  # Files up to this size are sent together with their header
+PROBE_SIZE = 64 * 1024  # Bytes test-compressed to decide whether compression is worth it
+MIN_COMPRESS_RATIO = 0.9  # Compress only if the probe shrinks below this fraction
+MIN_COMPRESS_SIZE = 512  # Smaller files are never compressed
+RETRY_DELAY = 5  # Seconds to wait before reconnecting after a failed attempt
+MAX_BUSY_WAIT = 300  # Seconds to keep waiting as long as the receiver answers busy
+DIGEST_ALGORITHM = "md5"  # Hash that verifies every file, one of DIGEST_ALGORITHMS
+LITERAL_CHUNK = 1024 * 1024  # Largest run of new bytes sent in one delta operation
+ADLER_MODULUS = 65521  # Modulus of zlib.adler32, needed to roll it
+ROLL_LIMIT = 1024 * 1024  # Bytes rolled over without a match before a delta only probes block-aligned offsets
+ROLL_WINDOW = 2 * 1024 * 1024  # Stretch of the file over which the share of rolled bytes is judged...
+MAX_ROLLED_SHARE = 0.25  # ...a delta starts probing once more than this share of it was rolled over
+PROBE_RESYNC = 2 * 1024 * 1024  # Bytes probed without a match before one block is rolled over, to find shifted data, doubling while nothing is found
+RESUME_ROLLING = 8  # Consecutive probes that match after which rolling resumes
+WATCH_INTERVAL = 1.0  # Seconds between two scans of the watched files
+SETTLE_TIME = 0.5  # Changes are sent once a scan this much later finds nothing more
+MAX_COALESCE = 30  # Seconds a burst of changes may keep delaying its batch
+IDLE_TIMEOUT = 30  # Seconds a watch connection stays open without changes, it holds one of the receiver's workers
 
-def calculate_md5(filename):
-    """Calculate MD5 hash of file"""
-    md5_hash = hashlib.md5()
+# Compressors for the codecs the receiver understands
+COMPRESSORS = {
+    CODEC_ZLIB: zlib.compressobj,
+    CODEC_LZMA: lzma.LZMACompressor,
+    CODEC_BZ2: bz2.BZ2Compressor,
+}
+
+def calculate_digest(filename):
+    """Calculate the DIGEST_ALGORITHM hash of file"""
+    file_hash = hashlib.new(DIGEST_ALGORITHM)
     with open(filename, "rb") as f:
         # Read file in chunks to handle large files efficiently
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+class FileShrank(OSError):
+    """The file got shorter while it was sent. The receiver waits for the
+    size from the header, so the connection cannot carry on."""
+
+    def __init__(self, sent, filesize):
+        super().__init__(f"File shrank while it was sent, got {sent} of {filesize} bytes")
+
+def send_with_sendfile(s, f, filesize, progress, offset=0):
+    """Send a regular file with sendfile(), the kernel copies the data
+    straight from the page cache to the socket"""
+    while offset < filesize:
+        # send in large slices so the progress bar keeps moving
+        sent = s.sendfile(f, offset, min(SENDFILE_CHUNK, filesize - offset))
+        if not sent:
+            raise FileShrank(offset, filesize)
+        offset += sent
+        progress.update(sent)
+
+def send_with_copy(s, f, filesize, progress):
+    """Send anything that is not a regular file (pipes, devices) chunk by
+    chunk, exactly filesize bytes of it"""
+    sent = 0
+    while sent < filesize:
+        # read the bytes from the file
+        bytes_read = f.read(min(BUFFER_SIZE, filesize - sent))
+        if not bytes_read:
+            raise FileShrank(sent, filesize)
+        sent += len(bytes_read)
+        # we use sendall to assure transmission in
+        # busy networks
+        s.sendall(bytes_read)
+        # update the progress bar
+        progress.update(len(bytes_read))
+
+def send_with_digest(s, f, filesize, file_hash, progress):
+    """Send the first filesize bytes of the file and update the digest in
+    the same pass, so it is read only once. Bytes appended meanwhile are
+    not sent, they were not in the header's size."""
+    buffer = memoryview(bytearray(STREAM_CHUNK))
+    sent = 0
+    while sent < filesize:
+        nbytes = f.readinto(buffer[:min(STREAM_CHUNK, filesize - sent)])
+        if not nbytes:
+            raise FileShrank(sent, filesize)
+        sent += nbytes
+        data = buffer[:nbytes]
+        file_hash.update(data)
+        s.sendall(data)
+        progress.update(nbytes)
+
+def worth_compressing(path):
+    """Test-compress the start of the file with fast zlib. Data that is
+    already compressed (archives, images, video) hardly shrinks and is
+    sent as it is."""
+    try:
+        with open(path, "rb") as f:
+            sample = f.read(PROBE_SIZE)
+    except OSError:
+        return False
+    if len(sample) < MIN_COMPRESS_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_COMPRESS_RATIO
+
+def send_compressed(s, f, length, compressor, progress, file_hash=None):
+    """Send the next length bytes of f as length-prefixed compressed chunks,
+    followed by an empty chunk. The digest (when given) is updated with the
+    original data."""
+    buffer = memoryview(bytearray(STREAM_CHUNK))
+    sent = 0
+    while sent < length:
+        nbytes = f.readinto(buffer[:min(STREAM_CHUNK, length - sent)])
+        if not nbytes:
+            raise FileShrank(sent, length)
+        sent += nbytes
+        data = buffer[:nbytes]
+        if file_hash:
+            file_hash.update(data)
+        compressed = compressor.compress(data)
+        if compressed:
+            s.sendall(CHUNK_LENGTH.pack(len(compressed)) + compressed)
+        progress.update(nbytes)
+    compressed = compressor.flush()
+    if compressed:
+        s.sendall(CHUNK_LENGTH.pack(len(compressed)) + compressed)
+    s.sendall(CHUNK_LENGTH.pack(0))
 
-def send_file(filename, host, port):
+class ReceiverBusy(ConnectionError):
+    """The receiver had no room for this connection"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Receiver is busy, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+def read_reply(replies):
+    """Read one line of reply from the receiver, raising ReceiverBusy when
+    it turned the connection away"""
+    line = replies.readline().decode().rstrip("\n")
+    if line.startswith(BUSY):
+        raise ReceiverBusy(int(line.split(SEPARATOR)[1]))
+    return line or "File transfer failed: Connection closed by receiver"
+
+def send_frame(s, replies, path, name, stream=False, resume=False, digests=None, progress=None, compress=None):
+    """Send one file as a frame on an open connection, compressed with the
+    compress codec if the file looks compressible.
+
+    Returns the receiver's answer if it turned the file down before any data
+    was sent, otherwise None and the answer is read later.
+    """
+    digests = {} if digests is None else digests
     # get the file size
-    filesize = os.path.getsize(filename)
-    # calculate md5 hash
-    file_md5 = calculate_md5(filename)
+    filesize = os.path.getsize(path)
+    # calculate the digest, unless it is sent as a trailer after the data
+    flags = FLAG_RESUME if resume else 0
+    if stream:
+        flags |= FLAG_TRAILER
+        file_digest = ""
+    else:
+        if path not in digests:
+            digests[path] = calculate_digest(path)
+        file_digest = digests[path]
+
+    codec = CODEC_NAMES[compress] if compress and worth_compressing(path) else CODEC_NONE
+
+    # send the filename, filesize and digest
+    header = pack_header(FileHeader(name, filesize, file_digest, flags, codec=codec, algorithm=DIGEST_ALGORITHM))
+    if not flags and codec == CODEC_NONE and filesize <= SMALL_FILE_SIZE and os.path.isfile(path):
+        # small file: header and data go out in a single call
+        with open(path, "rb") as f:
+            data = f.read(filesize)
+        if len(data) < filesize:
+            raise FileShrank(len(data), filesize)
+        s.sendall(header + data)
+        if progress:
+            progress.update(filesize)
+        return None
+    s.sendall(header)
+    offset = 0
+    if resume:
+        # the receiver answers with the number of bytes it already has
+        reply = read_reply(replies)
+        if not reply.startswith(RESUME):
+            return reply
+        offset = int(reply.split(SEPARATOR)[1])
+        if offset:
+            print(f"[+] Resuming {name} at byte {offset}")
+
+    # start sending the file, on its own progress bar unless one is shared
+    own_progress = progress is None
+    if own_progress:
+        progress = tqdm.tqdm(range(filesize), f"Sending {name}", unit="B", unit_scale=True, unit_divisor=1024, initial=offset)
+    else:
+        progress.update(offset)
+    with open(path, "rb") as f:
+        if codec != CODEC_NONE:
+            f.seek(offset)
+            file_hash = hashlib.new(DIGEST_ALGORITHM) if stream else None
+            send_compressed(s, f, filesize - offset, COMPRESSORS[codec](), progress, file_hash)
+            if stream:
+                s.sendall(file_hash.hexdigest().encode())
+        elif resume:
+            send_with_sendfile(s, f, filesize, progress, offset)
+        elif stream:
+            file_hash = hashlib.new(DIGEST_ALGORITHM)
+            send_with_digest(s, f, filesize, file_hash, progress)
+            # the receiver reads the digest right after the file data
+            s.sendall(file_hash.hexdigest().encode())
+        elif os.path.isfile(path):
+            send_with_sendfile(s, f, filesize, progress)
+        else:
+            send_with_copy(s, f, filesize, progress)
+    if own_progress:
+        progress.close()
+    return None
+
+def delta_operations(path, block_size, signatures):
+    """Yield the delta of the file against the receiver's blocks as
+    (operation bytes, file bytes they stand for) pairs.
+
+    A window of block_size bytes slides over the file. Its adler32 is
+    rolled along one byte at a time, so the expensive strong checksum is
+    only computed when the cheap one matches a block of the receiver.
+    Every matching window becomes a copy of that block, everything in
+    between is sent as literal bytes.
+
+    Rolling is slow in Python. In a region that is mostly new, after
+    ROLL_LIMIT bytes without a match or once a quarter of the recent
+    bytes were rolled over, only offsets in step with the last matching
+    block are probed, one block at a time. Rewritten data in place of old
+    data is found that way at the speed of zlib. After PROBE_RESYNC bytes
+    without a match one block is rolled over again, which finds data that
+    moved since, and then after twice as many, so a file that is new
+    throughout costs few of them. A row of matches switches back to rolling.
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    filesize = os.path.getsize(path)
+    if not filesize:
+        yield DELTA_OP.pack(DELTA_END, 0, 0), 0
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        copy_first = copy_count = copy_bytes = 0
+
+        def copy_run():
+            """The pending run of consecutive blocks as one copy operation"""
+            return [(DELTA_OP.pack(DELTA_COPY, copy_first, copy_count), copy_bytes)] if copy_count else []
+
+        def literal(start, end):
+            for chunk_start in range(start, end, LITERAL_CHUNK):
+                chunk = data[chunk_start:min(end, chunk_start + LITERAL_CHUNK)]
+                yield DELTA_OP.pack(DELTA_LITERAL, 0, len(chunk)) + chunk, len(chunk)
+
+        def find_block(start, end, checksum):
+            candidates = blocks.get(checksum)
+            return candidates.get(strong_checksum(data[start:end])) if candidates else None
+
+        position = literal_start = 0
+        rolling = False
+        probing = False
+        phase = 0  # Offset of the receiver's blocks in the file, from the last match
+        run = 0  # Bytes rolled over since the last match
+        run_limit = ROLL_LIMIT
+        rolled = 0  # Bytes rolled over in the current window
+        window_end = ROLL_WINDOW
+        probed = matches = 0  # Bytes probed since the last match, matches in a row while probing
+        resync = PROBE_RESYNC
+        resyncing = False
+        while position + block_size <= filesize:
+            if not rolling:
+                checksum = zlib.adler32(data[position:position + block_size])
+                a, b = checksum & 0xffff, checksum >> 16
+            index = find_block(position, position + block_size, (b << 16) | a)
+            if index is not None:
+                if literal_start < position:
+                    yield from copy_run()
+                    copy_count = 0
+                    yield from literal(literal_start, position)
+                if copy_count and index == copy_first + copy_count:
+                    copy_count += 1
+                    copy_bytes += block_size
+                else:
+                    yield from copy_run()
+                    copy_first, copy_count, copy_bytes = index, 1, block_size
+                position += block_size
+                literal_start = position
+                rolling = False
+                phase = position % block_size
+                run = probed = 0
+                run_limit = ROLL_LIMIT
+                resync = PROBE_RESYNC
+                resyncing = False
+                if probing:
+                    matches += 1
+                    # Back in old data, rolling finds small edits again
+                    probing = matches < RESUME_ROLLING
+                continue
+            if probing:
+                # Jump to the next offset in step with the receiver's blocks
+                step = block_size - (position - phase) % block_size
+                position += step
+                probed += step
+                matches = 0
+                rolling = False
+                if probed >= resync:
+                    # Roll over one block, any shift of the old data shows up within it
+                    probing, resyncing = False, True
+                    run, run_limit = 0, block_size
+            else:
+                # Slide the window one byte: drop the first byte, add the next one
+                if position + block_size < filesize:
+                    out, incoming = data[position], data[position + block_size]
+                    a = (a - out + incoming) % ADLER_MODULUS
+                    b = (b - block_size * out + a - 1) % ADLER_MODULUS
+                rolling = True
+                position += 1
+                run += 1
+                rolled += 1
+                if run >= run_limit:
+                    probing, probed, matches = True, 0, 0
+                    if resyncing:
+                        resync *= 2
+                        resyncing = False
+            if position >= window_end:
+                if rolled > MAX_ROLLED_SHARE * ROLL_WINDOW and not probing:
+                    probing, probed, matches = True, 0, 0
+                rolled = 0
+                window_end = position + ROLL_WINDOW
+            if position - literal_start >= LITERAL_CHUNK:
+                # Send long changes as they are found instead of at the end
+                yield from copy_run()
+                copy_count = 0
+                yield from literal(literal_start, position)
+                literal_start = position
+
+        # The receiver's last block may be shorter, it can only match the end of the file
+        index = find_block(position, filesize, zlib.adler32(data[position:filesize])) if position < filesize else None
+        if index is not None:
+            if literal_start < position:
+                yield from copy_run()
+                copy_count = 0
+                yield from literal(literal_start, position)
+            if not (copy_count and index == copy_first + copy_count):
+                yield from copy_run()
+                copy_first, copy_count, copy_bytes = index, 0, 0
+            copy_count += 1
+            copy_bytes += filesize - position
+            yield from copy_run()
+        else:
+            yield from copy_run()
+            yield from literal(literal_start, filesize)
+    yield DELTA_OP.pack(DELTA_END, 0, 0), 0
+
+def send_delta(s, replies, path, name, digests, progress=None, compress=None):
+    """Send only what changed since the receiver's previous copy of the file.
+
+    The receiver answers a delta query with the signatures of its blocks,
+    or with NEED when it has no earlier copy, and then the whole file is
+    sent. Returns the receiver's final answer.
+    """
+    filesize = os.path.getsize(path)
+    if filesize <= SMALL_FILE_SIZE:
+        # signatures and operations would cost more than the file
+        return send_frame(s, replies, path, name, digests=digests, progress=progress, compress=compress) or read_reply(replies)
+    if path not in digests:
+        digests[path] = calculate_digest(path)
+    header = FileHeader(name, filesize, digests[path], FLAG_DELTA | FLAG_QUERY, length=0, algorithm=DIGEST_ALGORITHM)
+    s.sendall(pack_header(header))
+    reply = read_reply(replies)
+    if reply == NEED:
+        return send_frame(s, replies, path, name, digests=digests, progress=progress, compress=compress) or read_reply(replies)
+    if not reply.startswith(DELTA):
+        # already stored, or an error
+        return reply
+    _, block_size, count = reply.split(SEPARATOR)
+    blob = replies.read(int(count) * SIGNATURE.size)
+    signatures = list(SIGNATURE.iter_unpack(blob))
+
+    own_progress = progress is None
+    if own_progress:
+        progress = tqdm.tqdm(range(filesize), f"Sending {name}", unit="B", unit_scale=True, unit_divisor=1024)
+    header.flags = FLAG_DELTA
+    s.sendall(pack_header(header))
+    sent = 0
+    for operation, covered in delta_operations(path, int(block_size), signatures):
+        s.sendall(operation)
+        sent += len(operation)
+        progress.update(covered)
+    if own_progress:
+        progress.close()
+    reply = read_reply(replies)
+    if reply.startswith("File received successfully"):
+        print(f"[+] {name}: sent {sent} bytes for {filesize} ({sent / max(filesize, 1):.1%})")
+    return reply
+
+def pipeline(s, replies, count, send):
+    """Call send() while a background thread reads count replies, and
+    return the replies in order.
+
+    A busy receiver answers before reading anything, the collector then
+    shuts the socket down so send() stops instead of sending everything
+    for nothing, and ReceiverBusy is raised. When the connection breaks,
+    the replies that never came are failures.
+    """
+    responses = []
+    busy = []
+    broken = []
+
+    def collect():
+        try:
+            for _ in range(count):
+                responses.append(read_reply(replies))
+        except ReceiverBusy as e:
+            busy.append(e)
+            s.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            broken.append(e)
+
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+    try:
+        send()
+    except OSError:
+        collector.join()
+        if busy:
+            raise busy[0]
+        raise
+    collector.join()
+    if busy:
+        raise busy[0]
+    if broken:
+        responses += [f"File transfer failed: {broken[0]}"] * (count - len(responses))
+    return responses
 
+def send_query(s, path, name, digests):
+    """Ask whether the receiver already stores this file's content"""
+    if path not in digests:
+        digests[path] = calculate_digest(path)
+    s.sendall(pack_header(FileHeader(name, os.path.getsize(path), digests[path], FLAG_QUERY, length=0,
+                                     algorithm=DIGEST_ALGORITHM)))
+
+def query_receiver(filename, host, port, file_digest):
+    """Ask over a connection of its own whether the receiver already
+    stores this file, and return its answer"""
+    s = socket.create_connection((host, port))
+    replies = s.makefile("rb")
+    try:
+        send_query(s, filename, os.path.basename(filename), {filename: file_digest})
+        return read_reply(replies)
+    finally:
+        replies.close()
+        s.close()
+
+def connect(host, port):
+    """Connect to the receiver, return the socket and a file to read its replies from"""
     # create the client socket
     s = socket.socket()
     print(f"[+] Connecting to {host}:{port}")
     s.connect((host, port))
     print("[+] Connected.")
+    return s, s.makefile("rb")
 
-    # send the filename, filesize and md5
-    s.send(f"{filename}{SEPARATOR}{filesize}{SEPARATOR}{file_md5}".encode())
+def send_files(files, host, port, stream=False, resume=False, digests=None, compress=None, dedup=False, delta=False):
+    """Send several (path, name) files over one new connection and return
+    the receiver's responses, in the same order"""
+    s, replies = connect(host, port)
+    try:
+        return send_batch(s, replies, files, stream, resume, digests, compress, dedup, delta)
+    finally:
+        # close the socket
+        replies.close()
+        s.close()
 
-    # start sending the file
-    progress = tqdm.tqdm(range(filesize), f"Sending {filename}", unit="B", unit_scale=True, unit_divisor=1024)
-    with open(filename, "rb") as f:
+def send_batch(s, replies, files, stream=False, resume=False, digests=None, compress=None, dedup=False, delta=False):
+    """Send several (path, name) files over an open connection and return
+    the receiver's responses, in the same order.
+
+    Frames are written back-to-back while a background thread collects the
+    answers, so small files do not each wait for a round-trip. Resumable
+    transfers wait for the receiver's offset, one file at a time, and so
+    do deltas for the signatures. With dedup the receiver is first asked
+    which contents it already has, and only the others are sent.
+    """
+    digests = {} if digests is None else digests
+    responses = [None] * len(files)
+    progress = None
+    try:
+        wanted = list(range(len(files)))
+        if dedup:
+            def send_queries():
+                for path, name in files:
+                    send_query(s, path, name, digests)
+
+            answers = pipeline(s, replies, len(files), send_queries)
+            wanted = [i for i, answer in enumerate(answers) if answer == NEED]
+            for i, answer in enumerate(answers):
+                if answer != NEED:
+                    responses[i] = answer
+            if len(wanted) < len(files):
+                print(f"[+] {len(files) - len(wanted)} of {len(files)} file(s) already stored on the receiver")
+
+        # one progress bar for the whole batch instead of one per file
+        if len(wanted) > 1:
+            total = sum(os.path.getsize(files[i][0]) for i in wanted)
+            progress = tqdm.tqdm(range(total), f"Sending {len(wanted)} files", unit="B", unit_scale=True, unit_divisor=1024)
+        if delta:
+            for i in wanted:
+                path, name = files[i]
+                responses[i] = send_delta(s, replies, path, name, digests, progress, compress)
+        elif resume:
+            for i in wanted:
+                path, name = files[i]
+                responses[i] = send_frame(s, replies, path, name, stream, resume, digests, progress, compress) or read_reply(replies)
+        else:
+            def send_wanted():
+                for i in wanted:
+                    path, name = files[i]
+                    send_frame(s, replies, path, name, stream, resume, digests, progress, compress)
+
+            answers = pipeline(s, replies, len(wanted), send_wanted)
+            for i, answer in zip(wanted, answers):
+                responses[i] = answer
+    finally:
+        if progress:
+            progress.close()
+    # A file the receiver never answered for counts as failed
+    return [response or "File transfer failed: No reply from receiver" for response in responses]
+
+def send_file(filename, host, port, stream=False, resume=False, file_digest=None, dedup=False, delta=False):
+    """Send one file and return the receiver's response"""
+    digests = {filename: file_digest} if file_digest else {}
+    return send_files([(filename, os.path.basename(filename))], host, port, stream, resume, digests, dedup=dedup, delta=delta)[0]
+
+def list_files(paths):
+    """Return (path, name) for every file to send.
+
+    Directories are walked, and their files are named by their path relative
+    to the directory's parent (build/bin/app), so the receiver can recreate
+    the layout. Plain files are sent under their base name.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(os.path.abspath(file_path), parent).replace(os.sep, "/")
+                    files.append((file_path, name))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+def scan(paths):
+    """Snapshot of the files under paths as {path: (name, size, mtime_ns)}.
+
+    Names are the same as list_files() gives. os.scandir() hands out the
+    entries of a directory without a separate listing, so a scan costs one
+    stat() per file.
+    """
+    snapshot = {}
+
+    def scan_directory(directory, prefix):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            # removed while scanning
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    scan_directory(entry.path, f"{prefix}/{entry.name}")
+                elif entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (f"{prefix}/{entry.name}", stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+
+    for path in paths:
+        if os.path.isdir(path):
+            scan_directory(path, os.path.basename(os.path.abspath(path)))
+        elif os.path.isfile(path):
+            stat = os.stat(path)
+            snapshot[path] = (os.path.basename(path), stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+def changed_files(paths, sent):
+    """Files under paths that are new or differ in size or mtime from the
+    copy in sent, which forgets files that are gone"""
+    snapshot = scan(paths)
+    for path in sent.keys() - snapshot.keys():
+        del sent[path]
+    return {path: entry for path, entry in snapshot.items() if sent.get(path) != entry}
+
+def connection_closed(s):
+    """Whether the receiver closed an idle connection. It never sends
+    anything unasked, so a readable socket means end of file or an error."""
+    readable, _, _ = select.select([s], [], [], 0)
+    return bool(readable)
+
+def watch(paths, host, port, interval=WATCH_INTERVAL, settle=SETTLE_TIME, **options):
+    """Keep sending new and changed files under paths until interrupted.
+
+    Every interval the paths are scanned and compared with what was sent.
+    Changes are collected until a scan settle seconds later finds no more,
+    so a burst of new files goes out as one batch. Batches share one
+    connection while changes keep coming. It is closed after IDLE_TIMEOUT
+    seconds without any, well before the receiver would time it out, so an
+    idle watcher does not keep a receiver worker from other senders. A file
+    that fails is sent again with the next batch.
+    """
+    sent = {}
+    s = replies = None
+    last_batch = 0
+    try:
         while True:
-            # read the bytes from the file
-            bytes_read = f.read(BUFFER_SIZE)
-            if not bytes_read:
-                # file transmitting is done
-                break
-            # we use sendall to assure transmission in
-            # busy networks
-            s.sendall(bytes_read)
-            # update the progress bar
-            progress.update(len(bytes_read))
+            changes = changed_files(paths, sent)
+            if not changes:
+                if s and time.monotonic() - last_batch > IDLE_TIMEOUT:
+                    replies.close()
+                    s.close()
+                    s = None
+                time.sleep(interval)
+                continue
+            deadline = time.monotonic() + MAX_COALESCE
+            while time.monotonic() < deadline:
+                time.sleep(settle)
+                later = changed_files(paths, sent)
+                if later == changes:
+                    break
+                changes = later
 
-    # wait for server confirmation
-    response = s.recv(1024).decode()
-    print(f"[+] Server response: {response}")
+            files = [(path, name) for path, (name, _, _) in changes.items()]
+            start = time.perf_counter()
+            try:
+                if s and connection_closed(s):
+                    replies.close()
+                    s.close()
+                    s = None
+                if not s:
+                    s, replies = connect(host, port)
+                responses = send_batch(s, replies, files, **options)
+                last_batch = time.monotonic()
+            except OSError as e:
+                if isinstance(e, ReceiverBusy):
+                    delay = e.retry_after
+                    print(f"[*] Receiver is busy, retrying in {delay} seconds")
+                else:
+                    delay = RETRY_DELAY
+                    print(f"[!] Transfer failed: {e}, retrying in {delay} seconds")
+                if s:
+                    replies.close()
+                    s.close()
+                    s = None
+                time.sleep(delay)
+                continue
 
-    # close the socket
-    s.close()
+            # What was sent is what the scan saw, a file changed since then goes out again
+            succeeded = sent_bytes = 0
+            for (path, name), response in zip(files, responses):
+                if response.startswith("File received successfully"):
+                    sent[path] = changes[path]
+                    succeeded += 1
+                    sent_bytes += changes[path][1]
+                else:
+                    print(f"[!] Server response for {name}: {response}")
+            elapsed = time.perf_counter() - start
+            print(f"[*] Sent {succeeded} of {len(files)} changed file(s), {sent_bytes / 1e6:.1f} MB in {elapsed:.2f} s")
+            if succeeded < len(files):
+                time.sleep(RETRY_DELAY)
+    finally:
+        if s:
+            replies.close()
+            s.close()
+
+def split_ranges(filesize, streams):
+    """Split a file into at most streams (offset, length) byte ranges, none for an empty file"""
+    if filesize == 0:
+        return []
+    streams = max(1, min(streams, filesize // MIN_RANGE_SIZE))
+    range_size = -(-filesize // streams)  # round up
+    return [(offset, min(range_size, filesize - offset)) for offset in range(0, filesize, range_size)]
+
+def send_range(filename, host, port, filesize, file_digest, offset, length, progress):
+    """Send bytes offset..offset+length of the file over its own connection"""
+    s = socket.socket()
+    s.connect((host, port))
+    replies = s.makefile("rb")
+    try:
+        s.sendall(pack_header(FileHeader(os.path.basename(filename), filesize, file_digest, FLAG_RANGE, offset, length,
+                                         algorithm=DIGEST_ALGORITHM)))
+        # wait until the receiver is ready for this range
+        reply = read_reply(replies)
+        if not reply.startswith(RANGE):
+            return reply
+        with open(filename, "rb") as f:
+            send_with_sendfile(s, f, offset + length, progress, offset)
+        return read_reply(replies)
+    finally:
+        replies.close()
+        s.close()
+
+def send_file_parallel(filename, host, port, streams, file_digest=None, dedup=False):
+    """Send one file as byte ranges over several connections at once and
+    return the receiver's response for the whole file"""
+    filesize = os.path.getsize(filename)
+    ranges = split_ranges(filesize, streams)
+    if len(ranges) < 2:
+        return send_file(filename, host, port, file_digest=file_digest, dedup=dedup)
+    if not file_digest:
+        file_digest = calculate_digest(filename)
+    if dedup:
+        # the receiver may already have it, then no range needs to be sent
+        response = query_receiver(filename, host, port, file_digest)
+        if response != NEED:
+            return response
+
+    print(f"[+] Sending {filename} to {host}:{port} over {len(ranges)} connections")
+    progress = tqdm.tqdm(range(filesize), f"Sending {filename}", unit="B", unit_scale=True, unit_divisor=1024)
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        responses = list(pool.map(lambda r: send_range(filename, host, port, filesize, file_digest, *r, progress), ranges))
+    progress.close()
+
+    # every range must have arrived, and the last one reports on the whole file
+    for response in responses:
+        if not response.startswith(("Range received", "File received successfully")):
+            return response
+    for response in responses:
+        if response.startswith("File received successfully"):
+            return response
+    return "File transfer failed: No range completed the file"
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simple File Sender")
-    parser.add_argument("file", help="File name to send")
+    parser.add_argument("files", help="File(s) or directories to send, everything shares one connection", nargs="+")
     parser.add_argument("host", help="The host/IP address of the receiver")
     parser.add_argument("-p", "--port", help="Port to use, default is 5001", type=int, default=5001)
+    parser.add_argument("-s", "--stream", help="Hash while sending and send the digest after the data (reads the file once)", action="store_true")
+    parser.add_argument("-r", "--resume", help="Continue an interrupted transfer instead of starting over", action="store_true")
+    parser.add_argument("-n", "--streams", help="Split each file over N parallel connections, default is 1", type=int, default=1)
+    parser.add_argument("-z", "--compress", help="Compress compressible files on the wire", choices=sorted(CODEC_NAMES))
+    parser.add_argument("-d", "--dedup", help="Skip files whose content the receiver already stores", action="store_true")
+    parser.add_argument("-a", "--digest", help=f"Hash that verifies the files, default is {DIGEST_ALGORITHM}",
+                        choices=DIGEST_ALGORITHMS, default=DIGEST_ALGORITHM)
+    parser.add_argument("--delta", help="Send only the blocks that changed since the receiver's previous copy of each file", action="store_true")
+    parser.add_argument("-w", "--watch", help="Keep running and send new and changed files as they appear", action="store_true")
+    parser.add_argument("--interval", help=f"With --watch, seconds between two scans, default is {WATCH_INTERVAL}",
+                        type=float, default=WATCH_INTERVAL)
+    parser.add_argument("--settle", help=f"With --watch, send once the changes stopped for this many seconds, default is {SETTLE_TIME}",
+                        type=float, default=SETTLE_TIME)
+    parser.add_argument("--retries", help="Reconnect and try again this many times after a failure, default is 0", type=int, default=0)
     args = parser.parse_args()
-    filename = args.file
+    if args.stream and args.resume:
+        parser.error("--resume needs the digest up front and cannot be combined with --stream")
+    if args.stream and args.dedup:
+        parser.error("--dedup needs the digest up front and cannot be combined with --stream")
+    if args.streams > 1 and (args.stream or args.resume or args.compress or args.delta):
+        parser.error("--streams cannot be combined with --stream, --resume, --compress or --delta")
+    if args.delta and (args.stream or args.resume):
+        parser.error("--delta cannot be combined with --stream or --resume")
+    if args.watch and args.streams > 1:
+        parser.error("--watch cannot be combined with --streams")
     host = args.host
     port = args.port
-    send_file(filename, host, port)
\ No newline at end of file
+    DIGEST_ALGORITHM = args.digest
+    if args.watch:
+        print(f"[*] Watching {', '.join(args.files)}, press Ctrl+C to stop")
+        try:
+            watch(args.files, host, port, args.interval, args.settle, stream=args.stream, resume=args.resume,
+                  compress=args.compress, dedup=args.dedup, delta=args.delta)
+        except KeyboardInterrupt:
+            print("[*] Stopped watching")
+        sys.exit(0)
+    # digests are calculated once and reused by every retry
+    digests = {}
+    pending = list_files(args.files)
+    total_files = len(pending)
+    total_bytes = sum(os.path.getsize(path) for path, _ in pending)
+    start = time.perf_counter()
+    attempt = 0
+    busy_wait = 0
+    while attempt <= args.retries:
+        try:
+            if args.streams > 1:
+                responses = [send_file_parallel(path, host, port, args.streams, digests.get(path), args.dedup) for path, _ in pending]
+            else:
+                responses = send_files(pending, host, port, stream=args.stream, resume=args.resume,
+                                       digests=digests, compress=args.compress, dedup=args.dedup, delta=args.delta)
+        except ReceiverBusy as e:
+            # Turned away before anything was sent, waiting does not use up a retry
+            if busy_wait + e.retry_after > MAX_BUSY_WAIT:
+                print(f"[!] Transfer failed: Receiver still busy after {busy_wait} seconds")
+                break
+            print(f"[*] Receiver is busy, retrying in {e.retry_after} seconds")
+            busy_wait += e.retry_after
+            time.sleep(e.retry_after)
+            continue
+        except OSError as e:
+            print(f"[!] Transfer failed: {e}")
+            responses = []
+        failed = []
+        for (path, name), response in zip(pending, responses):
+            if response.startswith("File received successfully"):
+                if total_files == 1:
+                    print(f"[+] Server response: {response}")
+            else:
+                print(f"[!] Server response for {name}: {response}")
+                failed.append((path, name))
+        # files without any response are retried too
+        pending = failed + pending[len(responses):]
+        if not pending:
+            break
+        attempt += 1
+        if attempt <= args.retries:
+            print(f"[*] Retrying {len(pending)} file(s) in {RETRY_DELAY} seconds ({attempt}/{args.retries})")
+            time.sleep(RETRY_DELAY)
+
+    elapsed = time.perf_counter() - start
+    sent = total_files - len(pending)
+    sent_bytes = total_bytes - sum(os.path.getsize(path) for path, _ in pending)
+    print(f"[*] Sent {sent} of {total_files} file(s), {sent_bytes / 1e6:.1f} MB in {elapsed:.2f} s "
+          f"({sent / elapsed:.1f} files/s, {sent_bytes / 1e6 / elapsed:.1f} MB/s)")
@@ -0,0 +1,102 @@
+"""
+Transfer benchmark
+Measures how the throughput of sender.py grows with the number of parallel
+streams. Everything runs on loopback, with wan_proxy.py in between to make
+the connection behave like a long-distance link
+"""
+import argparse
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from wan_proxy import WanProxy
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+RECEIVER_SCRIPT = os.path.join(SCRIPT_DIRECTORY, "file_receiver_service.py")
+SENDER_SCRIPT = os.path.join(SCRIPT_DIRECTORY, "sender.py")
+RETRIES = 20  # Attempts the sender gets when the proxy resets connections
+
+def free_port():
+    """Ask the OS for a port nobody is listening on"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    """Wait until something accepts connections on port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing is listening on port {port}")
+
+def run_sender(filename, port, streams, retries=0):
+    """Send filename through the proxy and return the elapsed seconds and
+    how often the sender had to try again.
+
+    With retries a single stream resumes where the reset left off, parallel
+    streams send the file again.
+    """
+    command = [sys.executable, SENDER_SCRIPT, filename, "127.0.0.1", "-p", str(port), "-n", str(streams)]
+    if retries:
+        command += ["--retries", str(retries)] + (["--resume"] if streams == 1 else [])
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    elapsed = time.perf_counter() - start
+    if "successfully" not in result.stdout:
+        raise RuntimeError(f"Transfer with {streams} stream(s) failed: {result.stdout.strip()}")
+    return elapsed, result.stdout.count("[*] Retrying")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput against the number of parallel streams")
+    parser.add_argument("--size", help="File size in MiB, default is 32", type=int, default=32)
+    parser.add_argument("--rtt", help="Round-trip time added by the proxy in ms, default is 80", type=float, default=80)
+    parser.add_argument("--bandwidth", help="Mbit/s of the emulated link, default is unlimited", type=float, default=0)
+    parser.add_argument("--jitter", help="Up to this many ms of random extra delay, default is 0", type=float, default=0)
+    parser.add_argument("--window", help="Bytes in flight per connection in KiB, default is 256", type=int, default=256)
+    parser.add_argument("--drop-every", help="Reset connections after this many MB on average, default is never", type=float, default=0)
+    parser.add_argument("--seed", help="Seed for jitter and drops, to repeat a run exactly", type=int)
+    parser.add_argument("--streams", help="Comma separated stream counts, default is 1,2,4,8", default="1,2,4,8")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    stream_counts = [int(n) for n in args.streams.split(",")]
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        filename = os.path.join(work_directory, "payload.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(args.size * 1024 * 1024))
+
+        receiver_port = free_port()
+        proxy_port = free_port()
+        receiver = subprocess.Popen(
+            [sys.executable, RECEIVER_SCRIPT, "-p", str(receiver_port),
+             "-d", os.path.join(work_directory, "received"), "-w", str(max(stream_counts)), "--no-catalog"],
+            cwd=work_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(receiver_port)
+            WanProxy(proxy_port, receiver_port, latency=args.rtt / 2000, bandwidth=args.bandwidth * 1e6 / 8,
+                     jitter=args.jitter / 1000, window=args.window * 1024, drop_every=args.drop_every * 1e6).start()
+
+            link = f"{args.bandwidth:g} Mbit/s" if args.bandwidth else "unlimited"
+            print(f"{args.size} MiB file, {args.rtt:g} ms round trip, {link} link, {args.jitter:g} ms jitter, "
+                  f"{args.window} KiB in flight per connection"
+                  + (f", a reset every {args.drop_every:g} MB" if args.drop_every else ""))
+            print(f"{'streams':>8} {'seconds':>8} {'MB/s':>8} {'retries':>8}")
+            for streams in stream_counts:
+                elapsed, retries = run_sender(filename, proxy_port, streams, RETRIES if args.drop_every else 0)
+                print(f"{streams:>8} {elapsed:>8.2f} {args.size * 1.048576 / elapsed:>8.1f} {retries:>8}")
+        finally:
+            receiver.send_signal(signal.SIGINT)
+            receiver.wait()
+
+if __name__ == "__main__":
+    main()
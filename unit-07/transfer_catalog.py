@@ -0,0 +1,174 @@
+"""
+Catalog of received files
+file_receiver_service.py records every file it stores in a SQLite database,
+with its name, path, size, digest, client and times. The indexes answer
+"did we get X, and what was its digest?" without scanning directories or
+grepping the log:
+
+    python transfer_catalog.py --name report.pdf
+    python transfer_catalog.py --digest 9e107d9d372bb6826bd81d3542a419d6
+    python transfer_catalog.py --since 2024-05-01 --until 2024-05-02
+"""
+import argparse
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+CATALOG_FILE = ".catalog.db"  # Name of the catalog in the save directory
+BATCH_SIZE = 1000  # Most records written in one transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,       -- name as sent, e.g. build/bin/app
+    path TEXT NOT NULL,       -- where the receiver stored it
+    size INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    client TEXT NOT NULL,     -- IP address of the sender
+    started REAL NOT NULL,    -- Unix time the transfer started
+    finished REAL NOT NULL,   -- Unix time the file was stored
+    method TEXT NOT NULL      -- upload, resume, ranges, delta or dedup
+);
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name, finished);
+CREATE INDEX IF NOT EXISTS files_by_digest ON files (digest);
+CREATE INDEX IF NOT EXISTS files_by_finished ON files (finished);
+"""
+COLUMNS = ("name", "path", "size", "algorithm", "digest", "client", "started", "finished", "method")
+
+def connect(path):
+    """Open the catalog at path, creating its table and indexes if needed"""
+    connection = sqlite3.connect(path)
+    # Readers do not block the writer and the other way round
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+class Catalog:
+    """Writes records of stored files on a background thread.
+
+    record() only puts the record on a queue, so a transfer never waits
+    for the database. The writer commits whatever is queued in one
+    transaction, so a burst of small files costs one commit, not one each.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        connect(path).close()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_records, name="catalog", daemon=True)
+        self.thread.start()
+
+    def record(self, name, path, size, algorithm, digest, client, started, finished, method):
+        self.queue.put((name, path, size, algorithm, digest, client, started, finished, method))
+
+    def write_records(self):
+        connection = connect(self.path)
+        # With WAL a crash can lose the last commits but never corrupts the catalog
+        connection.execute("PRAGMA synchronous=NORMAL")
+        running = True
+        while running:
+            rows = [self.queue.get()]
+            while len(rows) < BATCH_SIZE:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in rows:
+                running = False
+                rows = [row for row in rows if row is not None]
+            with connection:
+                connection.executemany(f"INSERT INTO files ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+        connection.close()
+
+    def close(self):
+        """Write out what is still queued"""
+        self.queue.put(None)
+        self.thread.join()
+
+def next_prefix(prefix):
+    """Smallest string greater than every string that starts with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def build_query(name=None, prefix=None, digest=None, client=None, since=None, until=None, limit=50):
+    """SQL and parameters that find the matching files, newest first.
+
+    Every condition can use an index: name and digest by equality, a
+    prefix and the times as a range. client alone needs a full scan.
+    """
+    conditions = []
+    parameters = []
+    if name:
+        conditions.append("name = ?")
+        parameters.append(name)
+    if prefix:
+        # A range instead of LIKE, which SQLite only runs on an index in special cases
+        conditions.append("name >= ? AND name < ?")
+        parameters += [prefix, next_prefix(prefix)]
+    if digest:
+        conditions.append("digest = ?")
+        parameters.append(digest.lower())
+    if client:
+        conditions.append("client = ?")
+        parameters.append(client)
+    if since is not None:
+        conditions.append("finished >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("finished < ?")
+        parameters.append(until)
+    sql = f"SELECT {', '.join(COLUMNS)} FROM files"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY finished DESC LIMIT ?"
+    return sql, parameters + [limit]
+
+def parse_time(text):
+    """Unix time of an ISO date or date and time, e.g. 2024-05-01 or 2024-05-01T12:30"""
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+def format_time(seconds):
+    return datetime.datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up received files in the catalog")
+    parser.add_argument("-c", "--catalog", help=f"Catalog file, default is received_files/{CATALOG_FILE}",
+                        default=os.path.join("received_files", CATALOG_FILE))
+    parser.add_argument("-n", "--name", help="Name the file was sent under, e.g. build/bin/app")
+    parser.add_argument("--prefix", help="Names starting with this, e.g. build/ for a whole directory")
+    parser.add_argument("--digest", help="Hex digest of the content")
+    parser.add_argument("--client", help="IP address of the sender")
+    parser.add_argument("--since", help="Stored at or after this ISO date or time", type=parse_time)
+    parser.add_argument("--until", help="Stored before this ISO date or time", type=parse_time)
+    parser.add_argument("--limit", help="Most files to list, newest first, default is 50", type=int, default=50)
+    parser.add_argument("--json", help="Print the files as JSON lines", action="store_true")
+    parser.add_argument("--explain", help="Show how SQLite runs the query instead of running it", action="store_true")
+    args = parser.parse_args()
+    if not os.path.exists(args.catalog):
+        parser.error(f"No catalog at {args.catalog}")
+
+    connection = connect(args.catalog)
+    sql, parameters = build_query(args.name, args.prefix, args.digest, args.client, args.since, args.until, args.limit)
+    if args.explain:
+        for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters):
+            print(row[-1])
+        return
+
+    rows = connection.execute(sql, parameters).fetchall()
+    for row in rows:
+        entry = dict(zip(COLUMNS, row))
+        if args.json:
+            print(json.dumps(entry))
+        else:
+            print(f"{format_time(entry['finished'])}  {entry['size']:>12}  {entry['algorithm']}:{entry['digest']}  "
+                  f"{entry['client']:<15} {entry['method']:<7} {entry['name']} -> {entry['path']}")
+    if not args.json:
+        # Records are never deleted, so the largest id is the count, without a full scan
+        total = connection.execute("SELECT MAX(id) FROM files").fetchone()[0] or 0
+        print(f"[*] {len(rows)} match(es), {total} file(s) in the catalog")
+
+if __name__ == "__main__":
+    main()
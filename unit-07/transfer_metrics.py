@@ -0,0 +1,115 @@
+"""
+Counters and histograms for file_receiver_service.py
+
+The receiver updates one Metrics object while it works. serve_metrics()
+publishes its snapshot as JSON on a small local HTTP endpoint:
+
+    curl http://127.0.0.1:9101/metrics
+"""
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, everything larger lands in a last open bucket
+SECONDS_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250]
+MB_PER_SECOND_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class Histogram:
+    """Counts observations per bucket, like a Prometheus histogram"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0,
+            "p50": round(self.quantile(0.5), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(self.max, 6),
+            "buckets": {str(bound): count for bound, count in zip(self.bounds + ["+Inf"], self.counts) if count},
+        }
+
+class Metrics:
+    """Thread-safe set of counters, gauges and histograms"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def adjust(self, name, amount):
+        """Move a gauge up or down, e.g. the number of active transfers"""
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name, value, bounds=SECONDS_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Answer GET /metrics with the JSON snapshot of metrics, on a background thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.snapshot(), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the console
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,130 @@
+"""
+Binary frame format shared by sender.py and file_receiver_service.py
+
+Every file sent over a connection starts with a fixed-size header:
+
+    magic       4 bytes   MAGIC, never the start of a text file name
+    version     1 byte    PROTOCOL_VERSION
+    flags       1 byte    FLAG_* bits below, bits 3-4 hold the CODEC_* number
+    algorithm   1 byte    index of the digest algorithm in DIGEST_ALGORITHMS
+    name_len    2 bytes   length of the UTF-8 file name that follows
+    digest_len  2 bytes   length of the hex digest (after the name, or after the data)
+    size        8 bytes   size of the whole file
+    offset      8 bytes   where the data of this frame starts in the file
+    length      8 bytes   bytes of file data in this frame
+
+followed by the name, the digest (unless FLAG_TRAILER is set) and the data.
+Compressed data is sent as chunks, each prefixed with its 4-byte length,
+and ends with an empty chunk. Numbers are big-endian. The receiver answers
+every frame with one line of text, so a sender can write many frames
+back-to-back and read the answers afterwards. A FLAG_QUERY frame is answered with NEED when the data has to
+be sent after all.
+
+A FLAG_DELTA | FLAG_QUERY frame asks for the signatures of the receiver's
+previous copy of the file. It is answered with NEED, with a success line
+when the content is already stored, or with DELTA<SEPARATOR>block
+size<SEPARATOR>count followed by count SIGNATUREs, one per block. The
+FLAG_DELTA frame that follows carries DELTA_OPs instead of the file
+data: copy blocks of the previous copy, literal bytes, end.
+"""
+import hashlib
+import math
+import struct
+from dataclasses import dataclass
+
+MAGIC = b"\x89XFR"
+PROTOCOL_VERSION = 2  # Version 2 added the digest algorithm
+HEADER = struct.Struct("!4sBBBHHQQQ")
+
+# Digest algorithms a sender may choose, the header carries the index
+DIGEST_ALGORITHMS = ["md5", "sha1", "sha256", "blake2b"]
+
+FLAG_TRAILER = 0x01  # The digest follows the data instead of the name
+FLAG_RESUME = 0x02   # The receiver replies with the offset to continue from
+FLAG_RANGE = 0x04    # The frame carries only bytes offset..offset+length of the file
+FLAG_QUERY = 0x20    # No data follows, the sender asks whether the receiver already has this content
+FLAG_DELTA = 0x40    # The data is a delta against the receiver's previous copy of the file
+
+# Compression of the data, stored in bits 3-4 of the flags
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA, "bz2": CODEC_BZ2}
+CODEC_SHIFT = 3
+CODEC_MASK = 0x03 << CODEC_SHIFT
+CHUNK_LENGTH = struct.Struct("!I")  # Prefix of every compressed chunk
+
+NEED = "NEED"  # Reply to FLAG_QUERY: unknown content, send the data
+DELTA = "DELTA"  # Reply to a delta query, the block signatures follow
+BUSY = "BUSY"    # First and only line sent to a client the receiver has no room for, followed by the seconds to wait
+
+# Delta transfers
+SIGNATURE = struct.Struct("!I16s")  # zlib.adler32 and strong_checksum() of one block
+DELTA_OP = struct.Struct("!cQI")    # operation, first block, block count (copy) or byte count (literal)
+DELTA_COPY = b"C"     # Copy blocks of the previous copy
+DELTA_LITERAL = b"L"  # The given number of new bytes follow
+DELTA_END = b"E"      # The file is complete
+DELTA_MIN_BLOCK = 1024
+DELTA_MAX_BLOCK = 128 * 1024
+
+def delta_block_size(size):
+    """Block size for the signatures of a file of size bytes, about its
+    square root like rsync, so big files do not get millions of blocks"""
+    return max(DELTA_MIN_BLOCK, min(DELTA_MAX_BLOCK, math.isqrt(size) // 1024 * 1024))
+
+def strong_checksum(block):
+    """Hash that confirms a block whose rolling checksum matched"""
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+class ProtocolError(Exception):
+    """The peer sent something that is not a valid frame"""
+
+@dataclass
+class FileHeader:
+    """Everything the receiver needs to know about one file before its data"""
+    name: str
+    size: int
+    digest: str = ""
+    flags: int = 0
+    offset: int = 0
+    length: int = None         # Defaults to size - offset
+    digest_length: int = None  # Length of the hex digest, also when it is a trailer
+    codec: int = CODEC_NONE
+    algorithm: str = "md5"
+
+    def __post_init__(self):
+        if self.length is None:
+            self.length = self.size - self.offset
+        if self.digest:
+            self.digest_length = len(self.digest)
+        elif self.digest_length is None:
+            self.digest_length = hashlib.new(self.algorithm).digest_size * 2
+
+def pack_header(header):
+    """Encode a FileHeader, name and digest included"""
+    name = header.name.encode()
+    digest = b"" if header.flags & FLAG_TRAILER else header.digest.encode()
+    flags = header.flags | (header.codec << CODEC_SHIFT)
+    algorithm = DIGEST_ALGORITHMS.index(header.algorithm)
+    fixed = HEADER.pack(MAGIC, PROTOCOL_VERSION, flags, algorithm, len(name), header.digest_length,
+                        header.size, header.offset, header.length)
+    return fixed + name + digest
+
+def unpack_header(data):
+    """Decode the fixed part of a header.
+
+    Returns the FileHeader, still without name and digest, and the length
+    of the name that follows it.
+    """
+    magic, version, flags, algorithm, name_length, digest_length, size, offset, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Not a file frame")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if algorithm >= len(DIGEST_ALGORITHMS):
+        raise ProtocolError(f"Unknown digest algorithm {algorithm}")
+    header = FileHeader("", size, flags=flags & ~CODEC_MASK, offset=offset, length=length,
+                        digest_length=digest_length, codec=(flags & CODEC_MASK) >> CODEC_SHIFT,
+                        algorithm=DIGEST_ALGORITHMS[algorithm])
+    return header, name_length
@@ -0,0 +1,246 @@
+"""
+WAN proxy
+TCP relay that makes a loopback connection behave like a long-distance link.
+It adds latency and jitter, caps the bandwidth and can cut connections, so
+sender.py and file_receiver_service.py can be measured under realistic
+conditions on one machine:
+
+    python file_receiver_service.py -p 5001 -w 4
+    python wan_proxy.py -p 6001 --target 5001 --rtt 80 --bandwidth 200
+    python sender.py big.iso 127.0.0.1 -p 6001 --streams 4
+"""
+import argparse
+import collections
+import random
+import socket
+import struct
+import threading
+import time
+
+PROXY_PORT = 6001      # Port the proxy listens on
+TARGET_HOST = "127.0.0.1"  # Where connections are relayed to
+TARGET_PORT = 5001     # The receiver's port
+RELAY_CHUNK = 64 * 1024  # Bytes read at once
+WINDOW = 4 * 1024 * 1024  # Bytes in flight per connection and direction, like the TCP window
+
+class Link:
+    """One direction of the emulated link, shared by every connection.
+
+    Data leaves the link one chunk after the other at the bandwidth, so
+    parallel connections split it like they would split a real line, and
+    then takes the latency plus a random jitter to arrive.
+    """
+
+    def __init__(self, latency, bandwidth, jitter):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+
+    def arrival(self, nbytes):
+        """Monotonic time at which nbytes sent now arrive at the other end"""
+        now = time.monotonic()
+        departure = now
+        if self.bandwidth:
+            with self.lock:
+                departure = max(now, self.free_at) + nbytes / self.bandwidth
+                self.free_at = departure
+        return departure + self.latency + random.uniform(0, self.jitter)
+
+class WanProxy:
+    """TCP relay from listen_port to target_host:target_port over an emulated link.
+
+    latency is one-way, in seconds, so an 80 ms round trip is a latency of
+    0.04. bandwidth is in bytes per second for each direction, 0 is
+    unlimited. Each chunk gets up to jitter extra seconds of delay, but
+    stays in order like in TCP. With drop_every, a connection is reset
+    after carrying a random number of bytes that averages drop_every.
+    """
+
+    def __init__(self, listen_port, target_port, latency=0, bandwidth=0, jitter=0, window=WINDOW, drop_every=0,
+                 target_host=TARGET_HOST, listen_host="127.0.0.1"):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.target_host = target_host
+        self.target_port = target_port
+        self.window = window
+        self.drop_every = drop_every
+        self.upstream_link = Link(latency, bandwidth, jitter)
+        self.downstream_link = Link(latency, bandwidth, jitter)
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def start(self):
+        """Listen and relay in the background"""
+        server_socket = socket.socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.listen_host, self.listen_port))
+        server_socket.listen(128)
+        threading.Thread(target=self.accept_loop, args=(server_socket,), daemon=True).start()
+        return self
+
+    def accept_loop(self, server_socket):
+        while True:
+            client, _ = server_socket.accept()
+            try:
+                upstream = socket.create_connection((self.target_host, self.target_port))
+            except OSError:
+                client.close()
+                self.count("refused")
+                continue
+            self.count("connections")
+            connection = Connection(client, upstream, self.drop_budget())
+            self.pump(connection, client, upstream, self.upstream_link, "bytes_up")
+            self.pump(connection, upstream, client, self.downstream_link, "bytes_down")
+
+    def drop_budget(self):
+        """Bytes the next connection may carry before it is cut, None for no limit"""
+        if not self.drop_every:
+            return None
+        return random.expovariate(1 / self.drop_every)
+
+    def pump(self, connection, source, destination, link, counter):
+        """Copy source to destination in the background over link.
+
+        Like a TCP window, bytes count as in flight until the data arrived
+        and its acknowledgement travelled back, a whole round trip.
+        """
+        in_flight = collections.deque()
+        acknowledged = collections.deque()
+        condition = threading.Condition()
+        queued = [0]
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(RELAY_CHUNK)
+                except OSError:
+                    data = b""
+                if data and not connection.carry(len(data)):
+                    self.count("dropped")
+                    connection.reset()
+                    data = b""
+                with condition:
+                    # stop reading while the window is full, the sender feels it as backpressure
+                    while True:
+                        now = time.monotonic()
+                        while acknowledged and acknowledged[0][0] <= now:
+                            queued[0] -= acknowledged.popleft()[1]
+                        if queued[0] < self.window:
+                            break
+                        condition.wait(acknowledged[0][0] - now if acknowledged else None)
+                    in_flight.append((link.arrival(len(data)) if data else time.monotonic(), data))
+                    queued[0] += len(data)
+                    condition.notify_all()
+                if not data:
+                    return
+
+        def write():
+            last_due = 0.0
+            while True:
+                with condition:
+                    while not in_flight:
+                        condition.wait()
+                    due, data = in_flight[0]
+                # jitter never reorders the stream
+                due = last_due = max(due, last_due)
+                pause = due - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+                try:
+                    if data:
+                        destination.sendall(data)
+                        self.count(counter, len(data))
+                    else:
+                        destination.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                with condition:
+                    in_flight.popleft()
+                    acknowledged.append((due + link.latency, len(data)))
+                    condition.notify_all()
+                if not data:
+                    connection.half_closed()
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+class Connection:
+    """Both sockets of one relayed connection and how much it may still carry"""
+
+    def __init__(self, client, upstream, budget):
+        self.sockets = (client, upstream)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.open_directions = 2
+
+    def carry(self, nbytes):
+        """Count nbytes against the drop budget, False once it is used up"""
+        if self.budget is None:
+            return True
+        with self.lock:
+            self.budget -= nbytes
+            return self.budget > 0
+
+    def reset(self):
+        """Cut the connection like a failing network: both ends get a reset"""
+        for s in self.sockets:
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                # close() alone would not wake a thread blocked in recv() on the socket
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+    def half_closed(self):
+        """One direction finished, close the sockets once both did"""
+        with self.lock:
+            self.open_directions -= 1
+            done = not self.open_directions
+        if done:
+            for s in self.sockets:
+                s.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP relay that emulates a WAN link")
+    parser.add_argument("-p", "--port", help=f"Port to listen on, default is {PROXY_PORT}", type=int, default=PROXY_PORT)
+    parser.add_argument("--listen-host", help="Address to listen on, default is 127.0.0.1", default="127.0.0.1")
+    parser.add_argument("--target", help=f"Port of the receiver, default is {TARGET_PORT}", type=int, default=TARGET_PORT)
+    parser.add_argument("--target-host", help=f"Host of the receiver, default is {TARGET_HOST}", default=TARGET_HOST)
+    parser.add_argument("--rtt", help="Round-trip time added in ms, half of it each way, default is 0", type=float, default=0)
+    parser.add_argument("--bandwidth", help="Mbit/s in each direction, shared by all connections, default is unlimited",
+                        type=float, default=0)
+    parser.add_argument("--jitter", help="Up to this many ms of random extra delay per chunk, default is 0", type=float, default=0)
+    parser.add_argument("--window", help=f"KiB in flight per connection and direction, default is {WINDOW // 1024}",
+                        type=int, default=WINDOW // 1024)
+    parser.add_argument("--drop-every", help="Reset connections after this many MB on average, default is never", type=float, default=0)
+    parser.add_argument("--seed", help="Seed for jitter and drops, to repeat a run exactly", type=int)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    proxy = WanProxy(args.port, args.target, latency=args.rtt / 2000, bandwidth=args.bandwidth * 1e6 / 8,
+                     jitter=args.jitter / 1000, window=args.window * 1024, drop_every=args.drop_every * 1e6,
+                     target_host=args.target_host, listen_host=args.listen_host).start()
+    print(f"[*] Relaying {args.listen_host}:{args.port} to {args.target_host}:{args.target}")
+    print(f"[*] {args.rtt:g} ms round trip, {f'{args.bandwidth:g} Mbit/s' if args.bandwidth else 'unlimited bandwidth'}, "
+          f"{args.jitter:g} ms jitter, {args.window} KiB window"
+          + (f", a reset every {args.drop_every:g} MB on average" if args.drop_every else ""))
+    print("[*] Press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stats = proxy.stats
+        print(f"\n[*] {stats['connections']} connection(s), {stats['dropped']} reset, {stats['refused']} refused by the target, "
+              f"{stats['bytes_up'] / 1e6:.1f} MB up, {stats['bytes_down'] / 1e6:.1f} MB down")
+
+if __name__ == "__main__":
+    main()